@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measures the steps per second of `run_episode` alone, against the stand-in simulator and agent nodes.
+
+Modes are one query at a time, pipelined query batches from threads, and pipelined batches on the event loop.
+
+Run from the repository root with `poetry run python benchmarks/orchestrator.py`.
+With the default zero delay, the nodes answer as fast as they can, so the result is the overhead of the evaluator and
+the FIFOs. Pass --delay to see how much of a slow node pipelining hides.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckietown_project.run_automated as run_automated
+from duckietown_project.async_interface import AsyncComponentInterface
+from duckietown_project.profiling import LatencyRecorder
+
+MODES = ["sequential", "pipelined", "async"]
+
+MAP_YAML = """tile_size: 0.585
+tiles:
+- [curve_left/W, curve_left/N]
+- [curve_left/S, curve_left/E]
+objects: []
+"""
+
+
+def start_node(node: str, fifo_dir: str, fifo_name: str, args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        AIDONODE_DATA_IN=os.path.join(fifo_dir, f"{fifo_name}-in"),
+        AIDONODE_DATA_OUT="fifo:" + os.path.join(fifo_dir, f"{fifo_name}-out"),
+    )
+    command = [sys.executable, "-m", "duckietown_project.standin", node, "--delay", str(args.delay), "--image-size", str(args.image_size)]
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(sim_ci, agent_ci, steps: int) -> tuple:
+    config = run_automated.config
+    scenario = run_automated.make_scenario("benchmark", MAP_YAML, 0, 0)
+    profile = LatencyRecorder()
+    config["episode_length_s"] = steps * config["physics_dt"]
+    start = time.perf_counter()
+    asyncio.run(run_automated.run_episode(sim_ci, agent_ci, config["physics_dt"], scenario, profile=profile))
+    return time.perf_counter() - start, profile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", default=500, type=int, help="steps per episode")
+    parser.add_argument("--repeat", default=3, type=int, help="episodes per mode")
+    parser.add_argument("--delay", default=0.0, type=float, help="seconds the nodes take for every input")
+    parser.add_argument("--image-size", default=30000, type=int, help="bytes in every camera and ui image")
+    # The async transport takes over the FIFOs for good, so it always runs last
+    parser.add_argument("--modes", nargs="*", default=MODES, choices=MODES)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as fifo_dir:
+        run_automated.config["fifo_dir"] = fifo_dir
+        nodes = [start_node("simulator", fifo_dir, "simulator", args), start_node("agent", fifo_dir, "ego0", args)]
+        try:
+            sim_ci, agent_ci = run_automated.connect_replica(0)
+            try:
+                for mode in sorted(args.modes, key=MODES.index):
+                    run_automated.config["pipelined"] = mode != "sequential"
+                    if mode == "async":
+                        sim_ci, agent_ci = AsyncComponentInterface(sim_ci), AsyncComponentInterface(agent_ci)
+                    rates = []
+                    profile = LatencyRecorder()
+                    for _ in range(args.repeat):
+                        seconds, episode_profile = run(sim_ci, agent_ci, args.steps)
+                        rates.append(args.steps / seconds)
+                        profile.merge(episode_profile)
+                    step = profile.histograms["step"]
+                    orchestration = profile.histograms["orchestration"]
+                    print(
+                        f"{mode:10} {max(rates):8.1f} steps/s (best of {args.repeat})  "
+                        f"step p50 {step.percentile(0.5) * 1000:.2f}ms  "
+                        f"orchestration p50 {orchestration.percentile(0.5) * 1000:.2f}ms"
+                    )
+            finally:
+                agent_ci.close()
+                sim_ci.close()
+        finally:
+            for node in nodes:
+                node.terminate()
+                node.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measures how long each subcommand of `python -m duckietown_project` takes to start.
+
+Run from the repository root with `poetry run python benchmarks/startup.py`.
+Pass --max-seconds to fail when a subcommand got slower than that, so slow imports don't creep back in.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Arguments to the python interpreter, the cheapest invocation that still loads everything a subcommand needs
+BENCHMARKS = {
+    "map": ["-m", "duckietown_project", "map", "--no-images", "--width", "3", "--height", "3", "--path", "{tmp}"],
+    "auto": ["-m", "duckietown_project", "auto", "--help"],
+    "automated": ["-c", "import duckietown_project.run_automated"],
+}
+
+
+def time_command(command, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("subcommands", nargs="*", default=list(BENCHMARKS), help="subcommands to measure")
+    parser.add_argument("--repeat", default=5, type=int, help="number of runs per subcommand")
+    parser.add_argument("--max-seconds", default=None, type=float, help="fail if the median startup is slower")
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.subcommands:
+            command = [part.format(tmp=tmp) for part in BENCHMARKS[name]]
+            timings = time_command(command, args.repeat)
+            median = statistics.median(timings)
+            print(f"{name:10} median {median:.3f}s  min {min(timings):.3f}s  max {max(timings):.3f}s")
+            if args.max_seconds is not None and median > args.max_seconds:
+                failed.append(name)
+
+    if failed:
+        print(f"Slower than {args.max_seconds}s: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
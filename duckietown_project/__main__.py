@@ -12,7 +12,37 @@ def run_auto_control(args):
 
 def run_automated(args):
     import duckietown_project.run_automated as run_automated
-    run_automated.main(args.scoring_root, args.scenario_path, args.fifos_dir)
+    run_automated.main(
+        args.scoring_root,
+        args.scenario_path,
+        args.fifos_dir,
+        args.catalog,
+        args.where,
+        pipelined=not args.sequential,
+        ui_image_every=args.ui_image_every,
+        state_dump_every=args.state_dump_every,
+        performance_every=args.performance_every,
+        replicas=args.replicas,
+        analysis_jobs=args.analysis_jobs,
+        log_format=args.log_format,
+        verify_metrics=args.verify_metrics,
+        episode_length_s=args.episode_length,
+        no_progress_window_s=args.no_progress_window,
+        no_progress_distance=args.no_progress_distance,
+        episode_budget_s=args.episode_budget,
+        run_budget_s=args.run_budget,
+        transport=args.transport,
+        checkpoint=args.checkpoint,
+        resume=args.resume,
+        sim_image=args.sim_image,
+        agent_image=args.agent_image,
+    )
+
+
+def run_convert_log(args):
+    from duckietown_project.episode_log import convert_to_cbor, LOG_NAMES
+    import os
+    convert_to_cbor(args.log, args.output or os.path.join(os.path.dirname(args.log), LOG_NAMES["cbor"]))
 
 
 if __name__ == "__main__":
@@ -35,7 +65,32 @@ if __name__ == "__main__":
     automated_parser.add_argument("--scoring-root", default="./scoring_root")
     automated_parser.add_argument("--scenario-path", default="./maps")
     automated_parser.add_argument("--fifos-dir", default="./fifos")
+    automated_parser.add_argument("--catalog", default=None, help="map catalog to evaluate, defaults to catalog.sqlite in --scenario-path")
+    automated_parser.add_argument("--where", default=None, help="SQL condition on the catalog selecting the maps to evaluate, e.g. \"loop_length >= 12\"")
+    automated_parser.add_argument("--sequential", action="store_true", help="wait for the reply to every query before sending the next, instead of pipelining them")
+    automated_parser.add_argument("--ui-image-every", default=1, type=int, help="log the top down image every this many steps, 0 for never (the video plays back faster accordingly)")
+    automated_parser.add_argument("--state-dump-every", default=1, type=int, help="log the full simulator state every this many steps, 0 for never")
+    automated_parser.add_argument("--performance-every", default=1, type=int, help="log the robot performance every this many steps, 0 for never")
+    automated_parser.add_argument("--replicas", default=1, type=int, help="number of simulator and agent pairs to run scenarios on in parallel")
+    automated_parser.add_argument("--analysis-jobs", default=None, type=int, help="number of processes making videos and statistics of finished episodes, defaults to the number of cpus")
+    automated_parser.add_argument("--log-format", default="cbor", choices=["cbor", "chunked"], help="episode log as plain cbor, or compressed chunks with a step index")
+    automated_parser.add_argument("--verify-metrics", action="store_true", help="also compute (and draw) the metrics from the episode log, and warn when they differ")
+    automated_parser.add_argument("--episode-length", default=200, type=float, help="length of an episode, in seconds of simulation")
+    automated_parser.add_argument("--no-progress-window", default=0, type=float, help="end an episode when the robot moved less than --no-progress-distance over this many seconds of simulation, 0 to disable")
+    automated_parser.add_argument("--no-progress-distance", default=0.1, type=float, help="in meters, see --no-progress-window")
+    automated_parser.add_argument("--episode-budget", default=0, type=float, help="end an episode after this many seconds of wall clock time, 0 for no limit")
+    automated_parser.add_argument("--run-budget", default=0, type=float, help="stop the run after this many seconds of wall clock time, skipping the scenarios left, 0 for no limit")
+    automated_parser.add_argument("--transport", default="threads", choices=["threads", "async"], help="talk to the nodes from threads, or on the event loop with non-blocking FIFOs")
+    automated_parser.add_argument("--checkpoint", default=None, help="file recording finished episodes, defaults to checkpoint.jsonl in --scoring-root")
+    automated_parser.add_argument("--resume", action="store_true", help="skip the episodes the checkpoint has for the same map, simulator, agent and settings")
+    automated_parser.add_argument("--sim-image", default="", help="identifies the simulator for --resume, e.g. its image digest")
+    automated_parser.add_argument("--agent-image", default="", help="identifies the agent for --resume, e.g. its image digest")
     automated_parser.set_defaults(func=run_automated)
 
+    convert_parser = subparsers.add_parser("convert-log", help="convert a chunked episode log to the plain cbor log")
+    convert_parser.add_argument("log", help="chunked log, with its .index.json next to it")
+    convert_parser.add_argument("--output", default=None, help="plain log to write, defaults to log.gs2.cbor next to the chunked log")
+    convert_parser.set_defaults(func=run_convert_log)
+
     args = parser.parse_args()
     args.func(args)
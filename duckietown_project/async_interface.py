@@ -0,0 +1,334 @@
+"""
+Asynchronous counterpart of zuper's ComponentInterface, reading and writing the FIFOs on the event loop.
+
+It takes over a ComponentInterface once that is connected (the protocol handshake stays synchronous), and from then on
+sends queries and reads replies without blocking, so episodes of all replicas share one loop without any threads.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+import cbor2
+from zuper_ipce import IEDO, IESO, ipce_from_object, ipce_from_typelike, object_from_ipce
+from zuper_ipce.constants import SCHEMA_ATT
+from zuper_nodes import ExternalNodeDidNotUnderstand, ExternalProtocolViolation, RemoteNodeAborted, TimingInfo
+from zuper_nodes_wrapper.constants import (
+    CTRL_ABORTED,
+    CTRL_NOT_UNDERSTOOD,
+    CTRL_OVER,
+    CTRL_UNDERSTOOD,
+    CUR_PROTOCOL,
+    FIELD_COMPAT,
+    FIELD_CONTROL,
+    FIELD_DATA,
+    FIELD_TOPIC,
+    TOPIC_ABORTED,
+)
+from zuper_nodes_wrapper.struct import MsgReceived
+from zuper_nodes_wrapper.wrapper_outside import ComponentInterface
+
+from duckietown_project.episode_log import decode_messages
+from duckietown_project.profiling import LatencyRecorder
+
+READ_SIZE = 1 << 16
+IEDO_NODES = IEDO(True, True)
+# The nodes are sent data without schema, the log gets it with, so it can be read without knowing the types
+IESO_NODES = IESO(use_ipce_from_typelike_cache=True, with_schema=False)
+IESO_LOG = IESO(use_ipce_from_typelike_cache=True, with_schema=True)
+
+
+class RawIPCE(NamedTuple):
+    """Data that is still encoded as it came in, passed on without converting it to an object and back"""
+    encoded: Union[bytes, memoryview]
+
+
+def _header(buf, pos: int) -> Tuple[int, Optional[int], int]:
+    """Major type and argument of the CBOR item at pos (None if of indefinite length), and where its content starts"""
+    major, info = buf[pos] >> 5, buf[pos] & 0x1F
+    pos += 1
+    if info < 24:
+        return major, info, pos
+    if info == 31:
+        return major, None, pos
+    if info > 27:
+        raise ValueError(f"Invalid CBOR item header {buf[pos - 1]:#x}")
+    size = 1 << (info - 24)
+    if pos + size > len(buf):
+        raise IndexError("CBOR item header cut short")
+    return major, int.from_bytes(buf[pos:pos + size], "big"), pos + size
+
+
+def _head(major: int, arg: int) -> bytes:
+    """Header of a CBOR item with a definite argument"""
+    if arg < 24:
+        return bytes([major << 5 | arg])
+    for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if arg < 1 << (8 * size):
+            return bytes([major << 5 | info]) + arg.to_bytes(size, "big")
+    raise ValueError(arg)
+
+
+def _item_end(buf, pos: int) -> int:
+    """Where the CBOR item at pos ends, without decoding it"""
+    major, arg, pos = _header(buf, pos)
+    if arg is None:
+        while buf[pos] != 0xFF:
+            pos = _item_end(buf, pos)
+        return pos + 1
+    if major in (0, 1, 7):
+        return pos
+    if major in (2, 3):
+        return pos + arg
+    if major == 4:
+        for _ in range(arg):
+            pos = _item_end(buf, pos)
+        return pos
+    if major == 5:
+        for _ in range(2 * arg):
+            pos = _item_end(buf, pos)
+        return pos
+    # A tag, followed by the tagged item
+    return _item_end(buf, pos)
+
+
+def map_value_span(buf, key: str, pos: int = 0) -> Tuple[int, int]:
+    """Where the encoding of the value of key in the CBOR map at pos starts and ends, only skipping the items before"""
+    major, count, pos = _header(buf, pos)
+    if major != 5 or count is None:
+        raise ValueError(f"Expecting a map looking for {key!r}")
+    encoded_key = cbor2.dumps(key)
+    for _ in range(count):
+        key_end = _item_end(buf, pos)
+        value_end = _item_end(buf, key_end)
+        if buf[pos:key_end] == encoded_key:
+            return key_end, value_end
+        pos = value_end
+    raise KeyError(key)
+
+
+def map_value(buf: bytes, key: str) -> memoryview:
+    """The encoding of the value of key in the CBOR map buf, without copying it"""
+    start, end = map_value_span(buf, key)
+    return memoryview(buf)[start:end]
+
+
+def with_schema(encoded_map, schema: bytes) -> List[Union[bytes, memoryview]]:
+    """Pieces of the encoding of a CBOR map with a schema added, like the one zuper writes to logs"""
+    major, count, pos = _header(encoded_map, 0)
+    return [_head(5, count + 1), memoryview(encoded_map)[pos:], cbor2.dumps(SCHEMA_ATT), schema]
+
+
+def message_head(topic: str) -> bytes:
+    """Encoding of a message on topic up to its data, which follows as the last value"""
+    return (
+        _head(5, 3)
+        + cbor2.dumps(FIELD_COMPAT) + cbor2.dumps([CUR_PROTOCOL])
+        + cbor2.dumps(FIELD_TOPIC) + cbor2.dumps(topic)
+        + cbor2.dumps(FIELD_DATA)
+    )
+
+
+class AsyncComponentInterface:
+    def __init__(self, ci: ComponentInterface):
+        self.ci = ci
+        self.nickname = ci.nickname
+        self.timeout = ci.timeout
+        self.fd_in = ci.fpin.fileno()
+        self.fd_out = ci.fpout.fileno()
+        # The synchronous interface can't be used anymore, its reads and writes would fail instead of waiting
+        os.set_blocking(self.fd_in, False)
+        os.set_blocking(self.fd_out, False)
+        self.buffer = bytearray()
+        self.messages: Deque[Tuple[Any, bytes]] = deque()
+        # Replies on these topics are returned as RawIPCE of the whole message, without decoding them
+        self.raw_topics: Set[str] = set()
+        self._schemas: Dict[Any, bytes] = {}
+        self._cc = None
+
+    def close(self):
+        self.ci.close()
+
+    def cc(self, f):
+        """Copy the messages on topics written and read to f, with schema, like ComponentInterface.cc"""
+        self._cc = f
+
+    def _log(self, topic: str, ipce):
+        if self._cc is not None:
+            self._cc.write(cbor2.dumps({FIELD_COMPAT: [CUR_PROTOCOL], FIELD_TOPIC: topic, FIELD_DATA: ipce}))
+            self._cc.flush()
+
+    def _log_encoded(self, topic: str, encoded_data, data_type):
+        """Log encoded data without schema with the schema of its type added, without decoding it"""
+        if self._cc is None:
+            return
+        if data_type not in self._schemas:
+            self._schemas[data_type] = cbor2.dumps(ipce_from_typelike(data_type, ieso=IESO_LOG))
+        for piece in [message_head(topic)] + with_schema(encoded_data, self._schemas[data_type]):
+            self._cc.write(piece)
+        self._cc.flush()
+
+    def _parse(self):
+        """Move the complete messages at the start of the buffer to self.messages"""
+        if not self.raw_topics:
+            self.messages.extend(decode_messages(self.buffer))
+            return
+        # One at a time, so the data of messages on raw topics is never decoded
+        while self.buffer:
+            parsed = self._parse_raw()
+            if parsed is None:
+                break
+            if parsed:
+                continue
+            decoded = decode_messages(self.buffer, limit=1)
+            if not decoded:
+                break
+            self.messages.extend(decoded)
+
+    def _parse_raw(self) -> Optional[bool]:
+        """
+        Move the message at the start of the buffer to self.messages if it is on a raw topic, without decoding its
+        data. Returns whether it was, or None if that message is still coming in.
+        """
+        try:
+            start, end = map_value_span(self.buffer, FIELD_TOPIC)
+            if end > len(self.buffer):
+                return None
+            topic = cbor2.loads(self.buffer[start:end])
+            if topic not in self.raw_topics:
+                return False
+            end = _item_end(self.buffer, 0)
+        except IndexError:
+            return None
+        except KeyError:
+            # A control message
+            return False
+        if end > len(self.buffer):
+            return None
+        raw = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        self.messages.append(({FIELD_TOPIC: topic}, raw))
+        return True
+
+    async def _wait(self, add, remove, fd: int):
+        loop = asyncio.get_event_loop()
+        ready = loop.create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, self.timeout)
+        except asyncio.TimeoutError:
+            raise ExternalProtocolViolation(f"Timeout after {self.timeout}s waiting for {self.nickname}") from None
+        finally:
+            remove(fd)
+
+    async def _write(self, data: bytes):
+        loop = asyncio.get_event_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd_in, view):]
+            except BlockingIOError:
+                await self._wait(loop.add_writer, loop.remove_writer, self.fd_in)
+            except BrokenPipeError:
+                raise RemoteNodeAborted(f'The pipe to node "{self.nickname}" is closed, the node exited') from None
+
+    async def _read_message(self) -> Tuple[dict, bytes]:
+        loop = asyncio.get_event_loop()
+        while not self.messages:
+            try:
+                data = os.read(self.fd_out, READ_SIZE)
+            except BlockingIOError:
+                await self._wait(loop.add_reader, loop.remove_reader, self.fd_out)
+                continue
+            if not data:
+                raise RemoteNodeAborted(f"{self.nickname} closed its output")
+            self.buffer += data
+            self._parse()
+        return self.messages.popleft()
+
+    async def write_topic(self, topic: str, data: Any = None):
+        if isinstance(data, RawIPCE):
+            # The same map as below, with the encoded data spliced in as its last value
+            await self._write(message_head(topic))
+            await self._write(data.encoded)
+            self._log_encoded(topic, data.encoded, self.ci.node_protocol.inputs[topic])
+            return
+        suggest_type = self.ci.node_protocol.inputs.get(topic, object)
+        ipce = ipce_from_object(data, suggest_type, ieso=IESO_NODES)
+        await self._write(cbor2.dumps({FIELD_COMPAT: [CUR_PROTOCOL], FIELD_TOPIC: topic, FIELD_DATA: ipce}))
+        if self._cc is not None:
+            self._log(topic, ipce_from_object(data, suggest_type, ieso=IESO_LOG))
+
+    async def read_reply(self, topic: str, expect: Optional[str]) -> Optional[MsgReceived]:
+        """
+        Read the reply to a query on topic, which is a message on the expected topic, or nothing if None.
+
+        Like zuper's read_reply, the node first tells whether it understood the query, and raises the same errors.
+        """
+        msg, _ = await self._read_message()
+        control = msg.get(FIELD_CONTROL)
+        if control == CTRL_ABORTED:
+            raise RemoteNodeAborted(f'The remote node "{self.nickname}" aborted with the following error:\n\n{msg.get(FIELD_DATA)}')
+        if control not in (CTRL_UNDERSTOOD, CTRL_NOT_UNDERSTOOD):
+            raise ExternalProtocolViolation(f"Remote node raised unknown code {control!r} in reply to {topic!r}")
+        explanation = msg.get(FIELD_DATA)
+
+        msgs = []
+        while True:
+            msg, raw = await self._read_message()
+            if msg.get(FIELD_CONTROL) == CTRL_ABORTED or msg.get(FIELD_TOPIC) == TOPIC_ABORTED:
+                raise RemoteNodeAborted(f'External node "{self.nickname}" aborted:\n\n{msg.get(FIELD_DATA)}')
+            if msg.get(FIELD_CONTROL) == CTRL_OVER:
+                break
+            msgs.append((msg, raw))
+        if control == CTRL_NOT_UNDERSTOOD:
+            raise ExternalNodeDidNotUnderstand(
+                f'The remote node "{self.nickname}" reports that it did not understand {topic!r}:\n\n{explanation}'
+            )
+
+        if expect is None:
+            if msgs:
+                raise ExternalProtocolViolation(f"Expecting zero messages in reply to {topic!r}, got {msgs}")
+            return None
+        if len(msgs) != 1 or msgs[0][0].get(FIELD_TOPIC) != expect:
+            raise ExternalProtocolViolation(f"Expecting one message on {expect!r} in reply to {topic!r}, got {msgs}")
+        msg, raw = msgs[0]
+        if expect in self.raw_topics:
+            self._log_encoded(expect, map_value(raw, FIELD_DATA), self.ci.node_protocol.outputs[expect])
+            return MsgReceived(expect, RawIPCE(raw), TimingInfo())
+        expect_type = self.ci.node_protocol.outputs[expect]
+        data = object_from_ipce(msg[FIELD_DATA], expect_type, iedo=IEDO_NODES)
+        if self._cc is not None:
+            self._log(expect, ipce_from_object(data, expect_type, ieso=IESO_LOG))
+        return MsgReceived(expect, data, TimingInfo())
+
+    def forward(self, reply: RawIPCE, *path: str) -> RawIPCE:
+        """The encoded value at path in the data of a raw reply, to pass on as the data of another message"""
+        encoded = map_value(reply.encoded, FIELD_DATA)
+        for key in path:
+            encoded = map_value(encoded, key)
+        return RawIPCE(encoded)
+
+    async def query_batch(
+        self,
+        queries: List[Tuple[str, Any, Optional[str]]],
+        pipelined: bool = True,
+        profile: Optional[LatencyRecorder] = None,
+    ) -> List[Optional[MsgReceived]]:
+        """Same as run_automated.query_batch, on the event loop"""
+        replies = []
+        if pipelined:
+            for topic, data, _ in queries:
+                await self.write_topic(topic, data)
+        start = time.perf_counter()
+        for topic, data, expect in queries:
+            if not pipelined:
+                start = time.perf_counter()
+                await self.write_topic(topic, data)
+            replies.append(await self.read_reply(topic, expect))
+            if profile is not None:
+                now = time.perf_counter()
+                profile.add(f"topic/{topic}", now - start)
+                start = now
+        return replies
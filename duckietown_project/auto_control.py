@@ -5,18 +5,36 @@
 This script runs the simulator headless
 """
 import argparse
-import numpy as np
-import pyglet
-pyglet.options["headless"] = True
-
-from gym_duckietown.envs import DuckietownEnv
-from PIL import Image
-from cv2 import VideoWriter, VideoWriter_fourcc, cvtColor, COLOR_RGB2BGR
+import glob
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Optional
 
 # from experiments.utils import save_img
 
 args = argparse.Namespace()
 
+
+def video_size(value: str):
+    try:
+        width, height = (int(side) for side in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expecting WIDTHxHEIGHT, got {value!r}") from None
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError(f"expecting a positive size, got {value!r}")
+    return width, height
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expecting at least 1, got {value}")
+    return number
+
+
 def init_args_parser(parser):
     parser.add_argument("--map-name", default="udem1")
     parser.add_argument("--distortion", default=False, action="store_true")
@@ -27,15 +45,27 @@ def init_args_parser(parser):
     parser.add_argument("--dynamics_rand", action="store_true", help="enable dynamics randomization")
     parser.add_argument("--frame-skip", default=1, type=int, help="number of frames to skip")
     parser.add_argument("--seed", default=1, type=int, help="seed")
+    parser.add_argument("--video-every", default=1, type=positive_int, help="add every this many steps to the video (it plays back faster accordingly)")
+    parser.add_argument("--video-size", default=(800, 600), type=video_size, help="resolution of the video, e.g. 400x300")
+    parser.add_argument("--no-video", action="store_true", help="don't render or write the video")
+    parser.add_argument("--trajectory", default="./trajectory.npz", help="record the pose, action, reward and done flag of every step to this file (one per map with --envs or --maps-dir, the map name appended), empty for none")
+    parser.add_argument("--envs", default=1, type=positive_int, help="number of environments to step in lockstep, each in its own process")
+    parser.add_argument("--maps-dir", default=None, help="run one episode on every map in this directory, spread over the --envs environments")
 
 def init_args(init):
     global args
     args = init
 
 
-def run():
-    env = DuckietownEnv(
-        seed=args.seed,
+def make_env(seed: int):
+    # The simulator stack is only imported when running, so building the command line parser stays fast
+    import pyglet
+    pyglet.options["headless"] = True
+
+    from gym_duckietown.envs import DuckietownEnv
+
+    return DuckietownEnv(
+        seed=seed,
         map_name=args.map_name,
         draw_curve=args.draw_curve,
         draw_bbox=args.draw_bbox,
@@ -46,52 +76,249 @@ def run():
         dynamics_rand=args.dynamics_rand,
     )
 
+
+def load_map_file(env, map_path: str):
+    """Load a map from any yaml file, _load_map only finds them by name in the simulator's own maps"""
+    import yaml
+
+    with open(map_path) as f:
+        map_data = yaml.load(f, Loader=yaml.SafeLoader)
+    env.map_name = os.path.splitext(os.path.basename(map_path))[0]
+    env.map_file_path = map_path
+    env.map_data = map_data
+    env._interpret_map(map_data)
+
+
+def control():
+    """The action of the built-in controller, driving straight ahead"""
+    import numpy as np
+
+    wheel_distance = 0.102
+    min_rad = 0.08
+
+    action = np.array([0.44, 0.0])
+
+    v1 = action[0]
+    v2 = action[1]
+    # Limit radius of curvature
+    if v1 == 0 or abs(v2 / v1) > (min_rad + wheel_distance / 2.0) / (min_rad - wheel_distance / 2.0):
+        # adjust velocities evenly such that condition is fulfilled
+        delta_v = (v2 - v1) / 2 - wheel_distance / (4 * min_rad) * (v1 + v2)
+        v1 += delta_v
+        v2 -= delta_v
+
+    action[0] = v1
+    action[1] = v2
+    return action
+
+
+class VideoEncoder:
+    """Converts, scales and writes frames to a video in a background thread, fed through a bounded queue"""
+
+    def __init__(self, path: str, size, fps: int = 30, queue_size: int = 32):
+        from cv2 import VideoWriter, VideoWriter_fourcc
+
+        self.size = size
+        self.writer = VideoWriter(path, VideoWriter_fourcc(*"MP4V"), fps, size)
+        # Blocks the simulation when the encoder falls this far behind, rather than holding every frame in memory
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def write(self, pixels):
+        # Waits in turns, so a dead encoder surfaces its error instead of blocking forever
+        while True:
+            self._check()
+            try:
+                self.frames.put(pixels, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Video encoder failed") from self.error
+        if not self.thread.is_alive():
+            raise RuntimeError("Video encoder stopped")
+
+    def _encode(self):
+        from cv2 import COLOR_RGB2BGR, INTER_AREA, cvtColor, resize
+
+        try:
+            while True:
+                pixels = self.frames.get()
+                if pixels is None:
+                    break
+                frame = cvtColor(pixels, COLOR_RGB2BGR)
+                if (frame.shape[1], frame.shape[0]) != self.size:
+                    frame = resize(frame, self.size, interpolation=INTER_AREA)
+                self.writer.write(frame)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.writer.release()
+
+    def close(self):
+        """Wait for the frames still queued to be written, and finish the video"""
+        # None ends the encoder, once the frames before it are written
+        self.write(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Video encoder failed") from self.error
+
+
+def run():
+    if args.envs > 1 or args.maps_dir is not None:
+        run_batch()
+        return
+
+    from PIL import Image
+    from duckietown_project.trajectory import TrajectoryRecorder
+
+    env = make_env(args.seed)
     env._load_map("generated")
     env.reset()
     pixels = env.render("top_down")
     im = Image.fromarray(pixels)
     im.save("./start.jpeg")
-    out = VideoWriter('./output_video.mp4', VideoWriter_fourcc(*'MP4V'), 30, (800, 600))
+    video = None if args.no_video else VideoEncoder("./output_video.mp4", args.video_size)
+    recorder = TrajectoryRecorder(args.trajectory, env.unwrapped.max_steps) if args.trajectory else None
 
+    steps = 0
     while True:
         """
         This function is called at every frame to handle
         movement/stepping and redrawing
         """
-        wheel_distance = 0.102
-        min_rad = 0.08
-
-        action = np.array([0.44, 0.0])
-
-        v1 = action[0]
-        v2 = action[1]
-        # Limit radius of curvature
-        if v1 == 0 or abs(v2 / v1) > (min_rad + wheel_distance / 2.0) / (min_rad - wheel_distance / 2.0):
-            # adjust velocities evenly such that condition is fulfilled
-            delta_v = (v2 - v1) / 2 - wheel_distance / (4 * min_rad) * (v1 + v2)
-            v1 += delta_v
-            v2 -= delta_v
-
-        action[0] = v1
-        action[1] = v2
+        action = control()
 
         obs, reward, done, info = env.step(action)
-        print("step_count = %s, reward=%.3f" % (env.unwrapped.step_count, reward))
+        steps += 1
+        if recorder is not None:
+            recorder.add(env.unwrapped.cur_pos, env.unwrapped.cur_angle, action, reward, done)
 
         if done:
-            print("done!")
+            print(f"done after {env.unwrapped.step_count} steps!")
+            if recorder is not None:
+                recorder.end_episode()
             env.reset()
             break
 
-        pixels = env.render("top_down")
-        frame = cvtColor(pixels, COLOR_RGB2BGR)
-        out.write(frame)
+        if video is not None and steps % args.video_every == 0:
+            video.write(env.render("top_down"))
         # im = Image.fromarray(pixels)
         # im.save("end.jpeg")
 
-    out.release()
+    if video is not None:
+        video.close()
+    env.close()
+
+
+def env_worker(conn, worker_args: argparse.Namespace, seed: int):
+    """Runs one environment in its own process, stepping it whenever the main process asks"""
+    from duckietown_project.trajectory import TrajectoryRecorder
+
+    global args
+    args = worker_args
+    env = make_env(seed)
+    recorder = None
+    while True:
+        command, payload = conn.recv()
+        if command == "episode":
+            name, map_path, episode_seed = payload
+            env.seed(episode_seed)
+            if map_path is None:
+                env._load_map("generated")
+            else:
+                load_map_file(env, map_path)
+            env.reset()
+            if args.trajectory:
+                recorder = TrajectoryRecorder(episode_trajectory_path(name), env.unwrapped.max_steps)
+            conn.send(None)
+        elif command == "step":
+            _, reward, done, _ = env.step(payload)
+            if recorder is not None:
+                recorder.add(env.unwrapped.cur_pos, env.unwrapped.cur_angle, payload, reward, done)
+                if done:
+                    recorder.end_episode()
+            conn.send((float(reward), bool(done)))
+        else:
+            break
     env.close()
 
+
+def episode_trajectory_path(name: str) -> str:
+    """Trajectory file of one episode in batch mode, the --trajectory file name with the episode's name added"""
+    root, extension = os.path.splitext(args.trajectory)
+    return f"{root}_{name}{extension}"
+
+
+def run_batch():
+    """
+    Run one episode per map on args.envs environments in worker processes. All environments step in lockstep, the
+    actions of a step are sent to every worker before any result is read, so the workers step at the same time.
+    """
+    import multiprocessing
+
+    if args.maps_dir is None:
+        map_paths = [None] * args.envs
+    else:
+        map_paths = sorted(glob.glob(os.path.join(args.maps_dir, "*.yaml")))
+    # Every episode gets its own seed, whichever worker runs it
+    episodes = deque(
+        (f"generated_{i}" if map_path is None else os.path.splitext(os.path.basename(map_path))[0], map_path, args.seed + i)
+        for i, map_path in enumerate(map_paths)
+    )
+    # The simulator's OpenGL context doesn't survive a fork
+    context = multiprocessing.get_context("spawn")
+    # Without the subcommand's function, which can't be pickled from __main__
+    worker_args = argparse.Namespace(**{name: value for name, value in vars(args).items() if name != "func"})
+    workers = []
+    for i in range(min(args.envs, len(episodes))):
+        conn, worker_conn = context.Pipe()
+        process = context.Process(target=env_worker, args=(worker_conn, worker_args, args.seed + i), daemon=True)
+        process.start()
+        workers.append((conn, process))
+
+    # Episode, steps and total reward of every worker with an episode running
+    running = {}
+
+    def start_episode(worker: int):
+        if episodes:
+            name, map_path, seed = episodes.popleft()
+            workers[worker][0].send(("episode", (name, map_path, seed)))
+            workers[worker][0].recv()
+            running[worker] = [name, 0, 0.0]
+
+    for worker in range(len(workers)):
+        start_episode(worker)
+
+    total_steps = 0
+    start = time.perf_counter()
+    try:
+        while running:
+            stepping = list(running)
+            for worker in stepping:
+                workers[worker][0].send(("step", control()))
+            for worker in stepping:
+                reward, done = workers[worker][0].recv()
+                episode = running[worker]
+                episode[1] += 1
+                episode[2] += reward
+                if done:
+                    print(f"{episode[0]}: {episode[1]} steps, reward {episode[2]:.3f}")
+                    del running[worker]
+                    start_episode(worker)
+            total_steps += len(stepping)
+    finally:
+        for conn, process in workers:
+            conn.send(("close", None))
+            process.join()
+
+    seconds = time.perf_counter() - start
+    print(f"{len(map_paths)} episodes, {total_steps} steps in {seconds:.1f}s, {total_steps / seconds:.1f} steps/s over {len(workers)} environments")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     init_args_parser(parser)
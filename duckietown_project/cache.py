@@ -0,0 +1,72 @@
+"""
+Content-addressed cache for map generation.
+
+Loops are cached per set of generation parameters, and previews per map content, so rerunning `map`
+only redoes the work for what actually changed.
+"""
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable, Iterator, List, Tuple
+
+# Bump when the loop generation changes, so old cached loops are not reused
+CACHE_VERSION = 1
+
+
+def params_key(params: dict) -> str:
+    data = json.dumps(dict(params, cache_version=CACHE_VERSION), sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def content_hash(map_data: dict) -> str:
+    # Hashed as json, which is a lot cheaper to produce than the yaml that is written
+    return hashlib.sha1(json.dumps(map_data, sort_keys=True).encode()).hexdigest()
+
+
+def cached_cycles(
+    cache_dir: str,
+    params: dict,
+    produce: Callable[[], Iterator[List[Tuple[int, int]]]],
+    refresh: bool = False,
+) -> Iterator[List[Tuple[int, int]]]:
+    """
+    The cycles produce() would give for these parameters, read from the cache if they were produced before.
+
+    The cache is only stored once produce() is exhausted, so an interrupted or limited run never leaves a partial list.
+    With refresh, the cycles are always produced again and replace the cached ones.
+    """
+    path = os.path.join(cache_dir, "loops", f"{params_key(params)}.jsonl")
+    if not refresh and os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                yield [tuple(cell) for cell in json.loads(line)]
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            for cycle in produce():
+                f.write(json.dumps(cycle) + "\n")
+                yield cycle
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def image_path(cache_dir: str, map_hash: str) -> str:
+    return os.path.join(cache_dir, "images", f"{map_hash}.jpeg")
+
+
+def save_cached_image(map_data, cache_path: str, path: str):
+    """Render the preview into the cache, and copy it to path"""
+    from duckietown_project.util import save_map_image
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Render under a temporary name, so a cached image is always complete
+    tmp_path = f"{cache_path}.{os.getpid()}.jpeg"
+    save_map_image(map_data, tmp_path)
+    os.replace(tmp_path, cache_path)
+    shutil.copyfile(cache_path, path)
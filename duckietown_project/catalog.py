@@ -0,0 +1,95 @@
+"""
+Catalog of generated maps, a single SQLite database in the map directory.
+
+It holds everything needed to evaluate a map (including the yaml itself), so the evaluator can load
+all scenarios with one query instead of opening several files per map.
+"""
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+CATALOG_NAME = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    name TEXT PRIMARY KEY,
+    idx INTEGER NOT NULL,
+    canonical_hash TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    loop_length INTEGER NOT NULL,
+    tile_counts TEXT NOT NULL,
+    start_x INTEGER NOT NULL,
+    start_y INTEGER NOT NULL,
+    yaml TEXT NOT NULL,
+    content_hash TEXT
+)
+"""
+
+
+def open_catalog(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute(SCHEMA)
+    return conn
+
+
+def add_map(
+    conn: sqlite3.Connection,
+    name: str,
+    idx: int,
+    canonical_hash: str,
+    size: Tuple[int, int],
+    loop_length: int,
+    tile_counts: Dict[str, int],
+    start: Tuple[int, int],
+    payload: str,
+    content_hash: str,
+):
+    conn.execute(
+        "INSERT OR REPLACE INTO maps "
+        "(name, idx, canonical_hash, width, height, loop_length, tile_counts, start_x, start_y, yaml, content_hash) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (name, idx, canonical_hash, size[0], size[1], loop_length, json.dumps(tile_counts), start[0], start[1], payload, content_hash),
+    )
+
+
+def has_map(conn: sqlite3.Connection, name: str, canonical_hash: str, size: Tuple[int, int]) -> bool:
+    """Whether the catalog has this loop under name, at this size"""
+    row = conn.execute(
+        "SELECT 1 FROM maps WHERE name = ? AND canonical_hash = ? AND width = ? AND height = ?",
+        (name, canonical_hash, size[0], size[1]),
+    ).fetchone()
+    return row is not None
+
+
+def map_content_hash(conn: sqlite3.Connection, name: str) -> Optional[str]:
+    row = conn.execute("SELECT content_hash FROM maps WHERE name = ?", (name,)).fetchone()
+    return row["content_hash"] if row is not None else None
+
+
+def load_maps(path: str, where: Optional[str] = None) -> List[sqlite3.Row]:
+    """
+    All maps in the catalog, in generation order.
+
+    where is an SQL condition selecting a subset, e.g. "loop_length >= 12" or
+    "json_extract(tile_counts, '$.\"3way_left/S\"') > 0".
+    Raises if there is no catalog at path or no map in it matches, rather than evaluating nothing.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No map catalog at {path}, generate the maps there first")
+    # Read-only, so a wrong path can't leave an empty catalog behind
+    conn = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        query = "SELECT * FROM maps"
+        if where:
+            query += f" WHERE {where}"
+        rows = conn.execute(query + " ORDER BY idx, name").fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        raise ValueError(f"No maps in {path}" + (f" matching {where!r}" if where else ""))
+    return rows
@@ -0,0 +1,47 @@
+"""
+Checkpoint of finished episodes, so an interrupted scoring run can resume where it stopped.
+
+Every finished episode is appended as a json line with its statistics. It is keyed by the content of its map and
+everything else its score depends on (the simulator and agent, and the evaluation settings), so a rerun only skips
+episodes that would score the same, whatever the maps are called.
+"""
+import hashlib
+import json
+import os
+from typing import Dict
+
+CHECKPOINT_NAME = "checkpoint.jsonl"
+
+
+def episode_key(map_yaml: str, identity: dict) -> str:
+    data = json.dumps({"map": map_yaml, "identity": identity}, sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def load_checkpoint(path: str) -> Dict[str, dict]:
+    """Statistics of the finished episodes by key, later entries win"""
+    finished = {}
+    if not os.path.isfile(path):
+        return finished
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash
+                continue
+            finished[entry["key"]] = entry["stats"]
+    return finished
+
+
+def record_episode(path: str, key: str, name: str, stats: dict):
+    line = (json.dumps({"key": key, "name": name, "stats": stats}) + "\n").encode()
+    with open(path, "ab+") as f:
+        # Start on a new line after one cut short by a crash, instead of appending to it
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
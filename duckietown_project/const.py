@@ -1,3 +1,4 @@
 WIDTH = 5
 HEIGHT = 5
 TILE_SIZE = 0.585
+MIN_LOOP_LENGTH = 5
@@ -0,0 +1,176 @@
+"""
+Episode logs, as the plain CBOR stream the analysis tools read, or in compressed chunks with a step index.
+
+A chunked log holds the exact bytes of the plain log, split in chunks that each start at a step and are compressed
+separately. The index records the chunk and offset every step starts at, so reading from step k only decompresses
+from the chunk holding it onwards, and convert_to_cbor gives back the plain log byte for byte.
+"""
+import json
+import os
+import struct
+import zlib
+from typing import Any, BinaryIO, Iterator, List, Optional, Tuple
+
+LOG_FORMATS = ("cbor", "chunked")
+LOG_NAMES = {"cbor": "log.gs2.cbor", "chunked": "log.gs2.chunks"}
+INDEX_SUFFIX = ".index.json"
+
+# Uncompressed size after which a chunk is closed at the next step
+CHUNK_SIZE = 1 << 20
+COMPRESSION_LEVEL = 6
+# Every chunk is preceded by its compressed length
+CHUNK_HEADER = struct.Struct(">I")
+
+
+class PlainLogWriter:
+    """The plain log, written under a temporary name until closed"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+
+    def write(self, data: bytes):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def mark_step(self, step: int):
+        pass
+
+    def close(self):
+        self.f.close()
+        os.rename(self.tmp_path, self.path)
+
+
+class ChunkedLogWriter:
+    """
+    Buffers the log, and writes it as compressed chunks of about CHUNK_SIZE, each starting at a step.
+
+    flush() leaves the buffer alone, as the component interfaces flush after every message.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.buffer = bytearray()
+        # Offset in the file of every chunk
+        self.chunks: List[int] = []
+        # Step, chunk number and offset within the uncompressed chunk of every step
+        self.steps: List[Tuple[int, int, int]] = []
+
+    def write(self, data: bytes):
+        self.buffer += data
+
+    def flush(self):
+        pass
+
+    def mark_step(self, step: int):
+        """Everything written from now on belongs to this step"""
+        if len(self.buffer) >= CHUNK_SIZE:
+            self._write_chunk()
+        self.steps.append((step, len(self.chunks), len(self.buffer)))
+
+    def _write_chunk(self):
+        if not self.buffer:
+            return
+        data = zlib.compress(bytes(self.buffer), COMPRESSION_LEVEL)
+        self.chunks.append(self.f.tell())
+        self.f.write(CHUNK_HEADER.pack(len(data)))
+        self.f.write(data)
+        self.buffer.clear()
+
+    def close(self):
+        self._write_chunk()
+        self.f.close()
+        with open(self.path + INDEX_SUFFIX, "w") as f:
+            json.dump({"chunks": self.chunks, "steps": self.steps}, f)
+        os.rename(self.tmp_path, self.path)
+
+
+def open_log(path: str, log_format: str):
+    if log_format == "chunked":
+        return ChunkedLogWriter(path)
+    return PlainLogWriter(path)
+
+
+class ChunkedLogReader:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        self.chunks: List[int] = index["chunks"]
+        self.steps = {step: (chunk, offset) for step, chunk, offset in index["steps"]}
+
+    def _chunks_from(self, f: BinaryIO, chunk: int) -> Iterator[bytes]:
+        if chunk >= len(self.chunks):
+            return
+        f.seek(self.chunks[chunk])
+        while header := f.read(CHUNK_HEADER.size):
+            (size,) = CHUNK_HEADER.unpack(header)
+            yield zlib.decompress(f.read(size))
+
+    def read_bytes(self, step: int = None) -> Iterator[bytes]:
+        """The plain log from the start of the given step (or the very start), a chunk at a time"""
+        chunk, offset = (0, 0) if step is None else self.steps[step]
+        with open(self.path, "rb") as f:
+            for data in self._chunks_from(f, chunk):
+                yield data[offset:]
+                offset = 0
+
+    def read_objects(self, step: int = None) -> Iterator[Any]:
+        """The messages in the log from the start of the given step"""
+        buffer = bytearray()
+        for data in self.read_bytes(step):
+            buffer += data
+            for ob, _ in decode_messages(buffer):
+                yield ob
+
+
+def decode_messages(buffer: bytearray, limit: Optional[int] = None) -> List[Tuple[Any, bytes]]:
+    """
+    Decode the complete CBOR messages at the start of buffer (at most limit), with their encoding, and remove them
+    from it.
+
+    What is left is the start of a message that is still coming in.
+    """
+    import cbor2
+
+    messages = []
+    consumed = 0
+    while consumed < len(buffer) and (limit is None or len(messages) < limit):
+        view = _View(buffer, consumed)
+        try:
+            ob = cbor2.CBORDecoder(view).decode()
+        except EOFError:
+            break
+        messages.append((ob, bytes(buffer[consumed:view.position])))
+        consumed = view.position
+    del buffer[:consumed]
+    return messages
+
+
+class _View:
+    """Minimal file over a buffer, from which CBORDecoder reads one message"""
+
+    def __init__(self, buffer: bytearray, position: int):
+        self.buffer = buffer
+        self.position = position
+
+    def read(self, n: int) -> bytes:
+        if self.position + n > len(self.buffer):
+            raise EOFError
+        data = bytes(self.buffer[self.position:self.position + n])
+        self.position += n
+        return data
+
+
+def convert_to_cbor(path: str, out_path: str):
+    """Write a chunked log as the plain log the analysis tools read"""
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for data in ChunkedLogReader(path).read_bytes():
+            f.write(data)
+    os.rename(tmp_path, out_path)
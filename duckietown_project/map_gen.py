@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
+from __future__ import annotations
 import argparse
-from cv2 import flip
+import hashlib
+import math
+import multiprocessing
+import sqlite3
 import yaml
 import logging
 import os
+import shutil
+import sys
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
 from random import Random
-from duckietown_world import MapFormat1
 
-import networkx as nx
-
-from typing import List, Tuple
+from itertools import islice
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
 from duckietown_project.const import *
-from duckietown_project.util import save_map_image, edge_path_to_format
+from duckietown_project.cache import cached_cycles, content_hash, image_path as cache_image_path, save_cached_image
+from duckietown_project.catalog import add_map, has_map, map_content_hash, open_catalog, CATALOG_NAME
+from duckietown_project.util import init_render_worker, save_map_image, edge_paths_to_formats, graph_transform, NORTH, EAST, SOUTH, WEST
 
 args = argparse.Namespace()
 rand = Random()
 
+# Number of loops converted to maps at once
+MAP_BATCH_SIZE = 256
+# Sampling draws from a pool of this many times the requested number of distinct loops
+SAMPLE_POOL_FACTOR = 10
+# Give up sampling after this many attempts per loop in the pool
+SAMPLE_MAX_ATTEMPTS = 100
+# Failed candidates in a row before duck placement moves on (and eventually gives up)
+PLACEMENT_TRIES = 30
+
 
 def init_args(init):
     global args
@@ -23,84 +41,53 @@ def init_args(init):
 
 
 def init_args_parser(parser: argparse.ArgumentParser):
-    parser.add_argument("--force", action="store_true", help="overwrite existing maps")
+    parser.add_argument("--force", action="store_true", help="overwrite existing maps and ignore the cache")
     parser.add_argument("--no-images", action="store_true", help="don't generate image views of the maps")
-    parser.add_argument("--width", default=5, help="width of the map to generate")
-    parser.add_argument("--height", default=5, help="height of the map to generate")
+    parser.add_argument("--jobs", default=os.cpu_count(), type=int, help="number of processes rendering the images")
+    parser.add_argument("--width", default=WIDTH, type=int, help="width of the map to generate")
+    parser.add_argument("--height", default=HEIGHT, type=int, help="height of the map to generate")
+    parser.add_argument("--min-length", default=MIN_LOOP_LENGTH, type=int, help="minimum number of tiles in a loop")
+    parser.add_argument("--keep-mirrored", action="store_true", help="keep mirror images of maps, only remove rotations")
+    parser.add_argument("--sample", default=None, type=int, help="randomly sample this many maps instead of generating all of them, for large grids")
+    parser.add_argument("--seed", default=1, type=int, help="seed for sampling maps and placing ducks")
+    parser.add_argument("--ducks", default=0, type=int, help="number of duckies to place on the road of every map")
+    parser.add_argument("--duck-dist", default=0.2, type=float, help="minimum distance between duckies, in meters")
+    parser.add_argument("--limit", default=None, type=int, help="stop after this many maps")
+    parser.add_argument("--resume", action="store_true", help="skip maps that are already on disk from the same loop and size")
     parser.add_argument("--file-name", default="map")
     parser.add_argument("--path", default="./maps")
+    parser.add_argument("--catalog", default=None, help=f"map catalog to write, defaults to {CATALOG_NAME} in --path")
+    parser.add_argument("--cache-dir", default=None, help="cache of generated loops and images, defaults to .cache in --path")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the cache")
 
 
-def save_map(map_path: str, map_data: MapFormat1):
+def save_map(map_path: str, payload: str, overwrite: bool = False) -> bool:
+    """Write the map, returns False if an existing one was kept instead"""
     assert map_path.endswith(".yaml")
-    if os.path.exists(map_path) and os.path.isfile(map_path):
-        logging.warning("Map already exists")
-        if not args.force:
-            logging.warning("Skipping")
-            return
+    if os.path.isfile(map_path) and not (args.force or overwrite):
+        logging.warning(f"Map {map_path} already exists, skipping")
+        return False
     logging.debug(f"Writing map to {map_path}")
 
     with open(map_path, "w") as f:
-        yaml.dump(map_data, f, default_flow_style=None)
-
-def neighs(x: int, y: int):
-    return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
-
-# def is_set(l: List[List[bool]], x: int, y: int) -> bool:
-#     if x < 0 or y < 0 or x >= args.width or y >= args.height:
-#         return False
-#     else:
-#         return l[y][x]
-
-# def gen_cycle() -> List[List[bool]]:
-#     cycle_map = []
-#     for i in range(args.height):
-#         cycle_map.append([False] * args.width)
-#     prevX = rand.randrange(args.width)
-#     prevY = rand.randrange(args.height)
-#     track = [(prevX, prevY)]
-#     visited = {(prevX, prevY)}
-#     cycle_map[prevY][prevX] = True
-
-#     while (sum([i in visited for i in neighs(prevX, prevY)]) < 2):
-#         x, y = rand.choice(neighs(prevX, prevY))
-#         if x < 0 or y < 0 or x >= args.width or y >= args.height or len(track) > 1 and(x, y) == track[-2]:
-#             continue
-#         track.append((x, y))
-#         visited.add((x, y))
-#         cycle_map[y][x] = True
-#         prevX, prevY = x, y
-    
-#     for x, y in neighs(prevX, prevY):
-#         if (x, y) in visited and (x, y) not in track[-2:]:
-#             for revX, revY in track[:track.index((x, y))]:
-#                 cycle_map[revY][revX] = False
-
-#     return cycle_map
+        f.write(payload)
+    return True
 
-# def gen_cycle2() -> List[List[bool]]:
-#     cycle_map = []
-#     for i in range(args.height):
-#         cycle_map.append([False] * args.width)
-#     prevX = rand.randrange(args.width)
-#     prevY = rand.randrange(args.height)
-#     candidates = {(prevX, prevY)}
-#     cycle_map[prevY][prevX] = True
-
-#     while candidates:
-#         prevX, prevY = candidates.pop()
-#         if (sum([is_set(cycle_map, xz, yz) for xz, yz in neighs(prevX, prevY)]) < 2):
-#             x, y = rand.choice(neighs(prevX, prevY))
-#             if x < 0 or y < 0 or x >= args.width or y >= args.height:
-#                 candidates.add((prevX, prevY))
-#                 continue
-#             candidates.add((x, y))
-#             cycle_map[y][x] = True
-#         if (sum([is_set(cycle_map, xz, yz) for xz, yz in neighs(prevX, prevY)]) < 2):
-#             candidates.add((prevX, prevY))
+def start_tile(tiles: List[List[str]]) -> Tuple[int, int]:
+    """
+    Location of the first found straight/E to use as start position, with y counted from the bottom.
 
+    The first is lowest y, then lowest x
+    This always exists because of the way valid cycles work
+    (no neighbour tiles that are not connected, so always a gap, so always a straight)
+    """
+    for y, row in enumerate(tiles):
+        if "straight/E" in row:
+            return row.index("straight/E"), len(tiles) - 1 - y
+    raise ValueError("Map has no straight/E tile to start on")
 
-#     return cycle_map
+def neighs(x: int, y: int):
+    return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
 
 # def full() -> List[List[Tuple[int, int, int, int]]]:
 #     cycle_map = []
@@ -108,12 +95,67 @@ def neighs(x: int, y: int):
 #         cycle_map.append([(i != 0, True, i != args.height - 1, False)] + [(i != 0, True, i != args.height - 1, True)] * (args.width - 2) + [(i != 0, False, i != args.height - 1, True)])
 #     return cycle_map
 
-def all_loops() -> List[List[Tuple[int, int]]]:
-    grid = nx.grid_2d_graph(args.width, args.height, create_using=nx.DiGraph)
-    # Not uniform over same shape cycles, for example there are lots of 2x2 cycles.
-    # Furthermore, they are directed, so all undirected cycles appear twice
-    # (unsure if different starting points count as distinct cycles, assuming not)
-    return list(nx.simple_cycles(grid))
+def grid_adjacency(width: int, height: int) -> List[List[int]]:
+    """Neighbours of every cell of the grid, cell ids follow flatten_idx so comparing ids is comparing flatten_idx"""
+    adjacent = [[] for _ in range(width * height)]
+    for x in range(width):
+        for y in range(height):
+            adjacent[x * height + y] = [ox * height + oy for ox, oy in neighs(x, y) if 0 <= ox < width and 0 <= oy < height]
+    return adjacent
+
+def all_loops(min_length: int = MIN_LOOP_LENGTH) -> Iterator[List[Tuple[int, int]]]:
+    """
+    Enumerate the induced (chordless) cycles of the grid with at least min_length tiles, each exactly once.
+
+    A cycle is only reported starting from its lowest cell (by flatten_idx), and only in the direction where
+    the second cell is lower than the last one. While extending the path, a cell may only be added if the tail
+    is its sole neighbour on the path, so a chord can never appear and no invalid cycle is ever built.
+    """
+    height = args.height
+    adjacent = grid_adjacency(args.width, args.height)
+    n_cells = len(adjacent)
+
+    on_path = [False] * n_cells
+    # Number of cells on the path next to each cell
+    touching = [0] * n_cells
+
+    def push(cell: int):
+        on_path[cell] = True
+        for other in adjacent[cell]:
+            touching[other] += 1
+
+    def pop(cell: int):
+        on_path[cell] = False
+        for other in adjacent[cell]:
+            touching[other] -= 1
+
+    for start in range(n_cells):
+        start_adjacent = set(adjacent[start])
+        push(start)
+        for second in adjacent[start]:
+            if second < start:
+                continue
+            path = [start, second]
+            push(second)
+            stack = [iter(adjacent[second])]
+            while stack:
+                for cell in stack[-1]:
+                    if cell < start or on_path[cell]:
+                        continue
+                    if cell in start_adjacent:
+                        # Closes the loop, only valid if the tail and start are its only neighbours on the path
+                        if touching[cell] == 2 and second < cell and len(path) + 1 >= min_length:
+                            yield [(c // height, c % height) for c in path + [cell]]
+                        continue
+                    if touching[cell] == 1:
+                        path.append(cell)
+                        push(cell)
+                        stack.append(iter(adjacent[cell]))
+                        break
+                else:
+                    stack.pop()
+                    pop(path.pop())
+        pop(start)
 
 def flatten_idx(x: Tuple[int, int]):
     return x[0] * args.height + x[1]
@@ -152,70 +194,90 @@ def validate_cycle(sequence: List[Tuple[int, int]]) -> bool:
 
 # def distance_measure(sol1: List[Tuple[int, int]], sol2: List[Tuple[int, int]]): 
 
-def check(bool_map: List[List[bool]], x: int, y: int, n: int, e: int, s: int, w: int) -> bool:
-    ee = bool_map[y][x + 1] if x + 1 < args.width else 0
-    ww = bool_map[y][x - 1] if x - 1 >= 0 else 0
-    ss = bool_map[y + 1][x] if y + 1 < args.height else 0
-    nn = bool_map[y - 1][x] if y - 1 >= 0 else 0
-    return ee == e and ww == w and nn == n and ss == s
-
 def map_transform(bool_map: List[List[bool]]) -> List[List[str]]:
-    tile_map = []
-    for i in range(args.height):
-        tile_map.append(["grass"] * args.width)
-    
-    for y in range(args.height):
-        for x in range(args.width):
-            if bool_map[y][x]:
-                if check(bool_map, x, y, 0, 1, 0, 1):
-                    tile_map[y][x] = "straight/E"
-                elif check(bool_map, x, y, 1, 0, 1, 0):
-                    tile_map[y][x] = "straight/S"
-                elif check(bool_map, x, y, 1, 1, 0, 0):
-                    tile_map[y][x] = "curve_left/S"
-                elif check(bool_map, x, y, 0, 1, 1, 0):
-                    tile_map[y][x] = "curve_left/W"
-                elif check(bool_map, x, y, 0, 0, 1, 1):
-                    tile_map[y][x] = "curve_left/N"
-                elif check(bool_map, x, y, 1, 0, 0, 1):
-                    tile_map[y][x] = "curve_left/E"
-                elif check(bool_map, x, y, 1, 1, 1, 0):
-                    tile_map[y][x] = "3way_left/S"
-                elif check(bool_map, x, y, 0, 1, 1, 1):
-                    tile_map[y][x] = "3way_left/W"
-                elif check(bool_map, x, y, 1, 0, 1, 1):
-                    tile_map[y][x] = "3way_left/N"
-                elif check(bool_map, x, y, 1, 1, 0, 1):
-                    tile_map[y][x] = "3way_left/E"
-                elif check(bool_map, x, y, 1, 1, 0, 1):
-                    tile_map[y][x] = "4way/E"
-                else:
-                    tile_map[y][x] = ""
-                    logging.error(f"Unknown tile: {x} {y}")
-    return tile_map
+    filled = np.array(bool_map, dtype=bool)
+    # Pad with grass, so tiles at the border have no connections leaving the map
+    padded = np.pad(filled, 1)
+    conn_map = padded[:-2, 1:-1] * NORTH | padded[1:-1, 2:] * EAST | padded[2:, 1:-1] * SOUTH | padded[1:-1, :-2] * WEST
+    conn_map[~filled] = 0
+    return graph_transform(conn_map.astype(np.uint8))
+
+class PlacementReport(NamedTuple):
+    requested: int
+    placed: int
+    # In meters
+    min_dist: float
+
+def object_placement(n: int, min_dist: float, possible_tiles: List[Tuple[int, int]], rng: Random = rand) -> Tuple[List[Tuple[float, float]], PlacementReport]:
+    """
+    Up to n random positions (in tiles) on the given tiles, at least min_dist meters apart.
 
-def object_placement(n: int, min_dist: float, possible_tiles: List[Tuple[int, int]]) -> List[Tuple[float, float]]:
+    Placed ducks are kept in a grid with cells of r / sqrt(2), which hold at most one duck each, so a candidate is checked
+    against the few ducks around it instead of all of them. Candidates are first drawn uniformly over the tiles. Once these
+    keep failing the map is getting full, and the free space is filled Poisson-disc style, from the annulus around placed
+    ducks. When even that runs out, no more ducks fit, and the report says how many were placed.
+    """
+    r = min_dist / TILE_SIZE
+    r_sq = r * r
+    cell_size = r / math.sqrt(2) if r > 0 else 1.0
+    tiles = set(possible_tiles)
+    tile_list = list(tiles)
+    grid = {}
     ducks = []
-    min_dist_sq = min_dist * min_dist
-    for _ in range(n):
-        for _ in range(50): # Max tries
-            # TODO verify these tile size calcs
-            xoff = rand.random() * TILE_SIZE
-            yoff = rand.random() * TILE_SIZE
-            startX, startY = rand.choice(possible_tiles)
-            x, y = startX * TILE_SIZE + xoff, startY * TILE_SIZE + yoff
-            if (all(map(lambda o: (x-o[0])**2 + (y-o[1])**2 > min_dist_sq, ducks))):
-                ducks.append((x, y))
+
+    def cell(x: float, y: float) -> Tuple[int, int]:
+        return math.floor(x / cell_size), math.floor(y / cell_size)
+
+    def fits(x: float, y: float) -> bool:
+        if (math.floor(x), math.floor(y)) not in tiles:
+            return False
+        cx, cy = cell(x, y)
+        for gx in range(cx - 2, cx + 3):
+            for gy in range(cy - 2, cy + 3):
+                other = grid.get((gx, gy))
+                if other is not None and (x - other[0]) ** 2 + (y - other[1]) ** 2 < r_sq:
+                    return False
+        return True
+
+    def place(x: float, y: float):
+        grid[cell(x, y)] = (x, y)
+        ducks.append((x, y))
+
+    failures = 0
+    while len(ducks) < n and failures < PLACEMENT_TRIES and tile_list:
+        tx, ty = rng.choice(tile_list)
+        x, y = tx + rng.random(), ty + rng.random()
+        if fits(x, y):
+            place(x, y)
+            failures = 0
+        else:
+            failures += 1
+
+    active = list(range(len(ducks))) if r > 0 else []
+    while len(ducks) < n and active:
+        i = rng.randrange(len(active))
+        x0, y0 = ducks[active[i]]
+        for _ in range(PLACEMENT_TRIES):
+            angle = rng.random() * 2 * math.pi
+            dist = r * (1 + rng.random())
+            x, y = x0 + dist * math.cos(angle), y0 + dist * math.sin(angle)
+            if fits(x, y):
+                place(x, y)
+                active.append(len(ducks) - 1)
                 break
-    return ducks
+        else:
+            active[i] = active[-1]
+            active.pop()
+
+    return ducks, PlacementReport(n, len(ducks), min_dist)
 
-def placements_to_ducks(placements: List[Tuple[float, float]]) -> List:
+def placements_to_ducks(placements: List[Tuple[float, float]], rng: Random = rand) -> List:
     return list(map(lambda x: {
         "height": 0.06,
         "kind": "duckie",
         "optional": False,
         "pos": [x[0], x[1]],
-        "rotate": rand.randrange(0, 360),
+        "rotate": rng.randrange(0, 360),
         "static": True
     }, placements))
 
@@ -225,71 +287,278 @@ def mirror_x(cycle: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
 def rotate(cycle: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
     return normalize_cycle(list(map(lambda x: (-x[1], x[0]), cycle)))
 
-def gen_maps() -> List[MapFormat1]:
-    choices = all_loops()
-    logging.warning(f"All loops generated {len(choices)} possibilities")
-    choices = list(filter(filter_cycles, choices))
-    logging.warning(f"Filtered generated {len(choices)} possibilities")
-    choices = list(map(list,set(map(tuple, map(normalize_cycle, choices)))))
-    logging.warning(f"Normalization generated {len(choices)} possibilities")
-
-    i = 0
-    while i < len(choices):
-        to_remove = set()
-
-        rot_1 = rotate(choices[i])
-        rot_2 = rotate(rot_1)
-        rot_3 = rotate(rot_2)
-
-        # Maybe shouldn't remove the flipped ones, as left turns may be perceived differently from right turns.
-        # Flipped can be removed if it is traversed both ways (left turn becomes right turn when taken from other side).
-        flipped_x = mirror_x(choices[i])
-
-        rot_1_f = rotate(flipped_x)
-        rot_2_f = rotate(rot_1_f)
-        rot_3_f = rotate(rot_2_f)
-
-        to_remove = [rot_1, rot_2, rot_3, flipped_x, rot_1_f, rot_2_f, rot_3_f]
-        to_remove = set(map(choices.index, to_remove))
-
-        # make sure that for maps that have a symmetry the original stays in the list
-        to_remove.discard(i)
+def symmetries(cycle: List[Tuple[int, int]], keep_mirrored: bool = False) -> List[List[Tuple[int, int]]]:
+    """
+    All rotations of the normalized cycle, and their mirror images unless keep_mirrored is set.
 
-        for remove in sorted(to_remove, reverse=True):
-            choices.pop(remove)
-        i += 1
+    Mirroring turns left turns into right turns, which are not necessarily driven the same way.
+    """
+    variants = [normalize_cycle(cycle)]
+    for _ in range(3):
+        variants.append(rotate(variants[-1]))
+    if not keep_mirrored:
+        variants.append(mirror_x(variants[0]))
+        for _ in range(3):
+            variants.append(rotate(variants[-1]))
+    return variants
+
+def canonical_cycle(cycle: List[Tuple[int, int]], keep_mirrored: bool = False) -> Tuple[Tuple[int, int], ...]:
+    """Smallest of the symmetric variants of the cycle, equal for all cycles that are the same up to symmetry"""
+    return min(map(tuple, symmetries(cycle, keep_mirrored)))
+
+def unique_cycles(cycles: Iterable[List[Tuple[int, int]]]) -> Iterator[List[Tuple[int, int]]]:
+    """
+    Normalize the cycles and only pass on the first of each set of symmetric variants.
 
-    logging.warning(f"Rotation elimination generated {len(choices)} possibilities")
-    choices = list(filter(validate_cycle, choices))
-    logging.warning(f"Validation generated {len(choices)} possibilities")
+    Every variant of a passed cycle goes into the set, so a single lookup of the normalized cycle is enough.
+    """
+    seen = set()
+    for cycle in cycles:
+        normalized = normalize_cycle(cycle)
+        if tuple(normalized) in seen:
+            continue
+        seen.update(map(tuple, symmetries(normalized, args.keep_mirrored)))
+        yield normalized
+
+def grow_loop(rng: Random, adjacent: List[List[int]], min_length: int) -> Optional[Tuple[List[int], float]]:
+    """
+    Grow a random induced loop from a random cell, picking uniformly from the cells that may extend the path.
 
-    maps = []
+    The same rules as all_loops keep the loop chordless. Returns the loop and the log of the inverse probability of
+    growing exactly this path, or None if the path got stuck.
+    """
+    n_cells = len(adjacent)
+    on_path = [False] * n_cells
+    touching = [0] * n_cells
+
+    def push(cell: int):
+        on_path[cell] = True
+        for other in adjacent[cell]:
+            touching[other] += 1
+
+    start = rng.randrange(n_cells)
+    start_adjacent = set(adjacent[start])
+    path = [start]
+    push(start)
+    log_weight = math.log(n_cells)
+    while True:
+        moves = []
+        for cell in adjacent[path[-1]]:
+            if on_path[cell]:
+                continue
+            if len(path) > 1 and cell in start_adjacent:
+                if touching[cell] == 2 and len(path) + 1 >= min_length:
+                    moves.append((cell, True))
+            elif touching[cell] == 1:
+                moves.append((cell, False))
+        if not moves:
+            return None
+        log_weight += math.log(len(moves))
+        cell, closes = rng.choice(moves)
+        path.append(cell)
+        push(cell)
+        if closes:
+            return path, log_weight
+
+def orbit_size(cycle: List[Tuple[int, int]], keep_mirrored: bool = False) -> int:
+    """Number of placements of the cycle on the grid, over all its distinct symmetric variants that fit"""
+    size = 0
+    for variant in set(map(tuple, symmetries(cycle, keep_mirrored))):
+        variant_width = max(x for x, _ in variant) + 1
+        variant_height = max(y for _, y in variant) + 1
+        size += max(0, args.width - variant_width + 1) * max(0, args.height - variant_height + 1)
+    return size
+
+def sample_loops(count: int, seed: int, pool_factor: int = SAMPLE_POOL_FACTOR) -> List[List[Tuple[int, int]]]:
+    """
+    Approximately uniform sample of distinct maps, drawn directly on grids too large to enumerate.
 
-    for edges in choices:
-        map_dict = edge_path_to_format(edges)
-        # map_dict["objects"] = placements_to_ducks(object_placement(5, 2, edges))
-        maps.append(map_dict)
-    return maps
+    Random loop growth favours some loops over others, so every grown loop is weighted by the inverse probability of
+    growing it (divided by the 2 * length ways to grow the same loop). The weights of a map are summed over all times it
+    was grown, and divided by its number of placements on the grid. The sample is then drawn without replacement from a
+    pool of pool_factor * count distinct candidates using these weights (sampling importance resampling).
+    """
+    rng = Random(seed)
+    height = args.height
+    adjacent = grid_adjacency(args.width, args.height)
+    candidates = {}  # canonical form -> [normalized cycle, summed weights in log space]
+    attempts = 0
+    max_attempts = SAMPLE_MAX_ATTEMPTS * count * pool_factor
+    while len(candidates) < count * pool_factor and attempts < max_attempts:
+        attempts += 1
+        grown = grow_loop(rng, adjacent, args.min_length)
+        if grown is None:
+            continue
+        path, log_weight = grown
+        cycle = [(c // height, c % height) for c in path]
+        if not filter_cycles(cycle):
+            continue
+        log_weight -= math.log(2 * len(cycle))
+        key = canonical_cycle(cycle, args.keep_mirrored)
+        if key in candidates:
+            candidate = candidates[key]
+            candidate[1] = log_add(candidate[1], log_weight)
+        else:
+            candidates[key] = [normalize_cycle(cycle), log_weight]
+    logging.warning(f"Sampling found {len(candidates)} distinct loops in {attempts} attempts")
+
+    # Weighted sampling without replacement: the smallest exponential(1) / weight win, compared in log space
+    keyed = []
+    for i, (cycle, log_weight) in enumerate(candidates.values()):
+        log_weight -= math.log(orbit_size(cycle, args.keep_mirrored))
+        noise = max(rng.expovariate(1.0), sys.float_info.min)
+        keyed.append((math.log(noise) - log_weight, i, cycle))
+    keyed.sort()
+    return [cycle for _, _, cycle in keyed[:count]]
+
+def log_add(a: float, b: float) -> float:
+    """log(exp(a) + exp(b)) without overflowing"""
+    if a < b:
+        a, b = b, a
+    return a + math.log1p(math.exp(b - a))
+
+def generation_params() -> dict:
+    """Everything the list of loops depends on"""
+    return {
+        "width": args.width,
+        "height": args.height,
+        "min_length": args.min_length,
+        "keep_mirrored": args.keep_mirrored,
+        "sample": args.sample,
+        "seed": args.seed,
+    }
+
+def get_cache_dir() -> str:
+    return args.cache_dir or os.path.join(args.path, ".cache")
+
+def iter_cycles() -> Iterator[List[Tuple[int, int]]]:
+    """Lazily produce the distinct, valid loops in a fixed order, so map indices are stable between runs"""
+    def produce():
+        if args.sample is not None:
+            choices = sample_loops(args.sample, args.seed)
+        else:
+            choices = unique_cycles(all_loops(args.min_length))
+        return filter(validate_cycle, choices)
+
+    if args.no_cache:
+        choices = produce()
+    else:
+        choices = cached_cycles(get_cache_dir(), generation_params(), produce, refresh=args.force)
+    # Filtered after the cache, so trying a different filter doesn't need a new enumeration
+    return filter(filter_cycles, choices)
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+def place_ducks(i: int, edges: List[Tuple[int, int]]) -> Tuple[List, PlacementReport]:
+    """The ducks on map i, seeded by the map index so a map comes out the same every run"""
+    if args.ducks <= 0:
+        return [], PlacementReport(0, 0, args.duck_dist)
+    rng = Random(f"{args.seed}:{i}")
+    placements, report = object_placement(args.ducks, args.duck_dist, edges, rng)
+    return placements_to_ducks(placements, rng), report
+
+def cycle_hash(edges: List[Tuple[int, int]]) -> str:
+    return hashlib.sha1(repr(canonical_cycle(edges, args.keep_mirrored)).encode()).hexdigest()
+
+def is_on_disk(catalog: sqlite3.Connection, i: int, edges: List[Tuple[int, int]]) -> bool:
+    """Whether map i was written before, from the same loop at the same size (not one of other parameters)"""
+    if not os.path.isfile(f"{args.path}/{args.file_name}_{i}.yaml"):
+        return False
+    if not has_map(catalog, f"{args.file_name}_{i}", cycle_hash(edges), (args.width, args.height)):
+        return False
+    return args.no_images or os.path.isfile(f"{args.path}/{args.file_name}_{i}.jpeg")
+
+def write_maps(pool: Optional[ProcessPoolExecutor], catalog: sqlite3.Connection):
+    # Maps are written as soon as they are produced, nothing is kept around
+    cycles = iter_cycles()
+    if args.limit is not None:
+        cycles = islice(cycles, args.limit)
+    todo = ((i, edges) for (i, edges) in enumerate(cycles) if not (args.resume and is_on_disk(catalog, i, edges)))
+    use_cache = not args.no_cache
+    cache_dir = get_cache_dir()
+
+    # Bound the number of queued images, so the renderers can't fall arbitrarily far behind
+    pending = set()
+
+    def render(fn, *fn_args):
+        nonlocal pending
+        if pool is None:
+            fn(*fn_args)
+            return
+        pending.add(pool.submit(fn, *fn_args))
+        if len(pending) >= 2 * args.jobs:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    written = 0
+    reused = 0
+    kept = 0
+    crowded = 0
+    # Small batches keep the tile conversion vectorized, while the first maps are still written quickly
+    for batch in batched(todo, MAP_BATCH_SIZE):
+        maps = edge_paths_to_formats([edges for _, edges in batch], args.width, args.height)
+        for (i, edges), k in zip(batch, maps):
+            k["objects"], report = place_ducks(i, edges)
+            if report.placed < report.requested:
+                crowded += 1
+            name = f"{args.file_name}_{i}"
+            map_path = f"{args.path}/{name}.yaml"
+            image_path = f"{args.path}/{name}.jpeg"
+            map_hash = content_hash(k)
+
+            # Maps with the same content as last time are left alone, as are their previews and catalog entries
+            unchanged = use_cache and not args.force and map_content_hash(catalog, name) == map_hash and os.path.isfile(map_path)
+            payload = None if unchanged else yaml.dump(k, default_flow_style=None)
+            if unchanged:
+                reused += 1
+            elif not save_map(map_path, payload, overwrite=use_cache):
+                # The catalog keeps describing the map that stays on disk, as does its preview
+                unchanged = True
+                kept += 1
+            else:
+                tile_counts = Counter(tile for row in k["tiles"] for tile in row)
+                add_map(catalog, name, i, cycle_hash(edges), (args.width, args.height), len(edges), tile_counts, start_tile(k["tiles"]), payload, map_hash)
+                written += 1
+
+            if not args.no_images and not (unchanged and os.path.isfile(image_path)):
+                if not use_cache:
+                    render(save_map_image, k, image_path)
+                else:
+                    cached_image = cache_image_path(cache_dir, map_hash)
+                    if os.path.isfile(cached_image) and not args.force:
+                        shutil.copyfile(cached_image, image_path)
+                    else:
+                        render(save_cached_image, k, cached_image, image_path)
+
+            if (written + reused + kept) % 100 == 0:
+                logging.warning(f"Written {written} maps, {reused} unchanged")
+        catalog.commit()
+
+    for future in pending:
+        future.result()
+    logging.warning(f"Written {written} maps, {reused} unchanged")
+    if kept:
+        logging.warning(f"Kept {kept} maps that were already on disk, use --force to overwrite them")
+    if crowded:
+        logging.warning(f"{crowded} maps have fewer than {args.ducks} ducks, they don't fit {args.duck_dist}m apart")
 
 def main():
-    maps = gen_maps()
-
-    for (i,k) in enumerate(maps):
-        save_map(f"{args.path}/{args.file_name}_{i}.yaml", k)
-        if not args.no_images: save_map_image(k, f"{args.path}/{args.file_name}_{i}.jpeg")
-        # Save the location of the first found straight/E to use as start position.
-        # The first is lowest y, then lowest x
-        # This always exists because of the way valid cycles work
-        # (no neighbour tiles that are not connected, so always a gap, so always a straight)
-        t = k["tiles"]
-        for y in range(len(t)):
-            try:
-                x = t[0].index("straight/E")
-                with open(f"{args.path}/{args.file_name}_{i}.start.txt", "w") as f:
-                    f.write(f"{x} {len(t) - 1 - y}")
-                break
-            except ValueError:
-                pass
+    catalog = open_catalog(args.catalog or os.path.join(args.path, CATALOG_NAME))
+    try:
+        if args.no_images or args.jobs <= 1:
+            write_maps(None, catalog)
+            return
+
+        # Spawn instead of fork, every worker sets up its own (headless) OpenGL context from scratch
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=init_render_worker) as pool:
+            write_maps(pool, catalog)
+    finally:
+        catalog.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -0,0 +1,57 @@
+"""
+Rule metrics of an episode, collected while it runs.
+
+The rules only depend on the trajectory of the robot on the map, so keeping the poses of the robot states as they
+come in is enough to evaluate them when the episode ends, instead of reading the whole log back.
+"""
+from typing import Dict, List
+
+
+def metrics_to_stats(evaluated) -> Dict[str, float]:
+    """Flatten evaluated rules to the total of every metric, named rule/metric"""
+    from duckietown_world.rules import EvaluatedMetric, RuleEvaluationResult
+
+    stats = {}
+    for k, evr in evaluated.items():
+        assert isinstance(evr, RuleEvaluationResult)
+        for m, em in evr.metrics.items():
+            assert isinstance(em, EvaluatedMetric)
+            assert isinstance(m, tuple)
+            if m:
+                M = "/".join(m)
+            else:
+                M = k
+            stats[M] = float(em.total)
+    return stats
+
+
+class EpisodeMetrics:
+    def __init__(self, robot_name: str, map_yaml: str):
+        self.robot_name = robot_name
+        self.map_yaml = map_yaml
+        self.timestamps: List[float] = []
+        self.poses: List = []
+
+    def add_robot_state(self, robot_state):
+        """Record the pose of a RobotState reply, if it is of this robot"""
+        if robot_state.robot_name != self.robot_name:
+            return
+        # Samples must be strictly increasing in time, a repeated query adds nothing
+        if self.timestamps and robot_state.t_effective <= self.timestamps[-1]:
+            return
+        self.timestamps.append(robot_state.t_effective)
+        self.poses.append(robot_state.state.pose)
+
+    def evaluate(self) -> Dict[str, float]:
+        """The same statistics as reading the log with read_and_draw, without drawing them"""
+        import yaml
+        from duckietown_world import SE2Transform
+        from duckietown_world.rules import evaluate_rules
+        from duckietown_world.seqs import SampledSequence
+        from duckietown_world.world_duckietown.map_loading import construct_map
+
+        world = construct_map(yaml.load(self.map_yaml, Loader=yaml.SafeLoader))
+        poses = SampledSequence[SE2Transform](self.timestamps, [SE2Transform.from_SE2(pose) for pose in self.poses])
+        interval = SampledSequence[float].from_iterator(enumerate(self.timestamps))
+        evaluated = evaluate_rules(poses_sequence=poses, interval=interval, world=world, ego_name=self.robot_name)
+        return metrics_to_stats(evaluated)
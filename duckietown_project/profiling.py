@@ -0,0 +1,98 @@
+"""
+Latency histograms of the evaluation loop, per topic and per step.
+
+Latencies go in fixed, logarithmic buckets, so a recorder stays small however long it runs, and the recorders of
+all episodes add up to one for the whole run.
+"""
+import json
+import math
+from typing import Dict, List
+
+# Buckets cover 10us to 100s, with 20 per factor of 10 (about 12% wide)
+MIN_LATENCY = 1e-5
+BUCKETS_PER_DECADE = 20
+BUCKETS = 7 * BUCKETS_PER_DECADE
+
+
+def bucket_upper_bound(bucket: int) -> float:
+    return MIN_LATENCY * 10 ** ((bucket + 1) / BUCKETS_PER_DECADE)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        if seconds <= MIN_LATENCY:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(seconds / MIN_LATENCY) * BUCKETS_PER_DECADE), BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, so at most one bucket too high"""
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+            # Upper bound of every non-empty bucket, with its count
+            "histogram": [[bucket_upper_bound(bucket), count] for bucket, count in enumerate(self.counts) if count],
+        }
+
+
+class LatencyRecorder:
+    """Histograms of named latencies, e.g. a topic or a whole step"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+
+    def add(self, name: str, seconds: float):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(seconds)
+
+    def merge(self, other: "LatencyRecorder"):
+        for name, histogram in other.histograms.items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].merge(histogram)
+
+    def summary(self) -> Dict[str, dict]:
+        return {name: self.histograms[name].summary() for name in sorted(self.histograms)}
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def table(self) -> List[str]:
+        """One line per latency, in milliseconds, slowest (in total) first"""
+        lines = [f"{'':32} {'count':>8} {'p50':>9} {'p95':>9} {'max':>9} {'total s':>9}"]
+        for name, h in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+            lines.append(
+                f"{name:32} {h.count:8} {h.percentile(0.5) * 1000:9.2f} {h.percentile(0.95) * 1000:9.2f} "
+                f"{h.max * 1000:9.2f} {h.total:9.1f}"
+            )
+        return lines
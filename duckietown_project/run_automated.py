@@ -3,32 +3,29 @@
 
 import logging
 
-from aido_analyze.utils_video import make_video_ui_image
 logging.basicConfig(level=logging.DEBUG)
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-import functools
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 from aido_schemas.protocol_simulator import FriendlyPose, FriendlyVelocity, RobotConfiguration, ScenarioRobotSpec
 import duckietown_challenges as dc
 import asyncio
 import os
 import traceback
 import shutil
+import time
 
-from typing import cast, Dict, Iterator, List, Optional, Set
+from typing import cast, Any, Dict, Iterator, List, Optional, Tuple
 
-from aido_analyze.utils_drawing import read_and_draw
 from aido_schemas import (
     DB20ObservationsOnlyState,
     DB20ObservationsPlusState,
     DB20ObservationsWithTimestamp,
-    DTSimStateDump,
     DumpState,
     EpisodeStart,
     GetCommands,
     GetDuckieState,
     GetRobotObservations,
     GetRobotState,
-    JPGImage,
     protocol_agent_DB20_fullstate,
     protocol_agent_DB20_onlystate,
     protocol_agent_DB20_timestamps,
@@ -36,10 +33,7 @@ from aido_schemas import (
     PROTOCOL_NORMAL,
     protocol_simulator_DB20_timestamps,
     ProtocolDesc,
-    RobotName,
     RobotObservations,
-    RobotPerformance,
-    RobotState,
     Scenario,
     SetMap,
     SetRobotCommands,
@@ -48,143 +42,381 @@ from aido_schemas import (
     SpawnRobot,
     Step,
 )
-from duckietown_world import Tile
-from duckietown_world.rules import EvaluatedMetric, RuleEvaluationResult
 
 from zuper_nodes import ExternalProtocolViolation, RemoteNodeAborted
-from zuper_nodes_wrapper import Profiler, ProfilerImp, logger
+from zuper_nodes_wrapper import logger
 from zuper_nodes_wrapper.struct import MsgReceived
-from zuper_nodes_wrapper.wrapper_outside import ComponentInterface
+from zuper_nodes_wrapper.wrapper_outside import ComponentInterface, read_reply
+
+from duckietown_project.async_interface import AsyncComponentInterface
+from duckietown_project.catalog import load_maps, CATALOG_NAME
+from duckietown_project.checkpoint import episode_key, load_checkpoint, record_episode, CHECKPOINT_NAME
+from duckietown_project.episode_log import convert_to_cbor, open_log, LOG_NAMES
+from duckietown_project.metrics import metrics_to_stats, EpisodeMetrics
+from duckietown_project.profiling import LatencyRecorder
+from duckietown_project.termination import RUN_BUDGET, SIMULATOR_DONE, TerminationPolicy
 
 config = {
     "timeout_regular": 120,
     "timeout_initialization": 120,
     "fifo_dir": "/fifos",
-    "sim_in": "/fifos/simulator-in",
-    "sim_out": "/fifos/simulator-out",
     "seed": 888,
-    "physics_dt": 0.05
+    "physics_dt": 0.05,
+    # Write the independent queries of a step back to back, instead of waiting for each reply
+    "pipelined": True,
+    # Log these topics every this many steps, or never for 0
+    "ui_image_every": 1,
+    "state_dump_every": 1,
+    "performance_every": 1,
+    # Number of simulator and agent pairs running scenarios side by side
+    "replicas": 1,
+    # Processes making the videos and statistics of finished episodes
+    "analysis_jobs": os.cpu_count(),
+    # "cbor" for the plain log, or "chunked" for compressed chunks with a step index
+    "log_format": "cbor",
+    # Also compute the statistics from the log afterwards (drawing them as well), and compare
+    "verify_metrics": False,
+    "episode_length_s": 200,
+    # End an episode once the robot moved less than no_progress_distance meters over no_progress_window_s of
+    # simulation, or after episode_budget_s of wall clock time, 0 disables
+    "no_progress_window_s": 0.0,
+    "no_progress_distance": 0.1,
+    "episode_budget_s": 0.0,
+    # Wall clock time after which the run stops, 0 for no limit
+    "run_budget_s": 0.0,
+    "run_deadline": None,
+    # "threads" runs the blocking component interfaces in threads, "async" reads and writes the FIFOs on the event loop
+    "transport": "threads",
+    # Finished episodes are recorded here, and skipped when resuming
+    "checkpoint": None,
+    "resume": False,
+    # Identify the simulator and agent (e.g. by image digest), episodes only count as done for the same ones
+    "sim_image": "",
+    "agent_image": "",
 }
 
 def robot_stats(fn, dn_i, pc_name):
+    # The analysis stack is heavy, and only needed once an episode has finished
+    from aido_analyze.utils_drawing import read_and_draw
+    from duckietown_world import Tile
+
     Tile.style = "synthetic"
     evaluated = read_and_draw(fn, dn_i, pc_name)
-
-    stats = {}
-    for k, evr in evaluated.items():
-        assert isinstance(evr, RuleEvaluationResult)
-        for m, em in evr.metrics.items():
-            assert isinstance(em, EvaluatedMetric)
-            assert isinstance(m, tuple)
-            if m:
-                M = "/".join(m)
-            else:
-                M = k
-            stats[M] = float(em.total)
-    return stats
-
-async def main_async(cie: dc.ChallengeInterfaceEvaluator, log_dir: str, scenarios: List[Scenario]):
-    all_player_robots: Set[RobotName] = set()
-    all_player_robots.add("ego0")
-    all_controlled_robots: Dict[RobotName, str] = {}
-    all_controlled_robots["ego0"] = "PROTOCOL_NORMAL"
-    # episode = episodes[0]
-    if not os.path.exists(config["fifo_dir"]):
-        os.makedirs(config["fifo_dir"])
-    fifo_in = os.path.join(config["fifo_dir"], "ego0-in")
-    fifo_out = os.path.join(config["fifo_dir"], "ego0-out")
-
-    if os.path.exists(fifo_in): os.remove(fifo_in)
-    if os.path.exists(fifo_out): os.remove(fifo_out)
-    if os.path.exists(config["sim_in"]): os.remove(config["sim_in"])
-    if os.path.exists(config["sim_out"]): os.remove(config["sim_out"])
+    return metrics_to_stats(evaluated)
+
+def replica_fifo(name: str, index: int) -> str:
+    """FIFO of a node, replica 0 keeps the plain name so a single replica setup is unchanged"""
+    if index == 0:
+        return os.path.join(config["fifo_dir"], name)
+    node, direction = name.rsplit("-", 1)
+    return os.path.join(config["fifo_dir"], f"{node}-{index}-{direction}")
+
+def connect_replica(index: int) -> Tuple[ComponentInterface, ComponentInterface]:
+    """Connect to the simulator and agent of a replica, waits until both are up"""
+    fifo_in = replica_fifo("ego0-in", index)
+    fifo_out = replica_fifo("ego0-out", index)
+    sim_in = replica_fifo("simulator-in", index)
+    sim_out = replica_fifo("simulator-out", index)
+    for fifo in (fifo_in, fifo_out, sim_in, sim_out):
+        if os.path.exists(fifo): os.remove(fifo)
 
     # This is long running, previously managed by timeout
     agent_ci = ComponentInterface(
         fifo_in,
         fifo_out,
         expect_protocol=protocol_agent_DB20_timestamps,
-        nickname="ego0",
+        nickname="ego0" if index == 0 else f"ego0-{index}",
         timeout=config["timeout_regular"],
     )
     agent_ci._get_node_protocol(timeout=config["timeout_initialization"])
 
-    logger.debug("Now initializing sim connection", sim_in=config["sim_in"], sim_out=config["sim_out"])
+    logger.debug("Now initializing sim connection", sim_in=sim_in, sim_out=sim_out)
     # This is long running, previously managed by timeout
     sim_ci = ComponentInterface(
-        config["sim_in"],
-        config["sim_out"],
+        sim_in,
+        sim_out,
         expect_protocol=protocol_simulator_DB20_timestamps,
-        nickname="simulator",
+        nickname="simulator" if index == 0 else f"simulator-{index}",
         timeout=config["timeout_regular"],
     )
     try:
         sim_ci._get_node_protocol(timeout=config["timeout_initialization"])
-
-        per_episode = {}
-
         sim_ci.write_topic_and_expect_zero("seed", config["seed"])
         agent_ci.write_topic_and_expect_zero("seed", config["seed"])
-        for scenario in scenarios:
-            dn = os.path.join(log_dir, scenario.scenario_name)
-            if os.path.exists(dn):
-                shutil.rmtree(dn)
-
-            if not os.path.exists(dn):
-                os.makedirs(dn)
-            fn = os.path.join(dn, "log.gs2.cbor")
-
-            fn_tmp = fn + ".tmp"
-            fw = open(fn_tmp, "wb")
-
-            agent_ci.cc(fw)
-            sim_ci.cc(fw)
-
-            logger.info(f"Now running episode {scenario.scenario_name}")
-
-            try:
-                length_s = await run_episode(
-                    sim_ci,
-                    agent_ci,
-                    scenario=scenario,
-                    physics_dt=config["physics_dt"],
-                )
-                logger.info(f"Finished episode {scenario.scenario_name} with length {length_s:.2f}")
-            except:
-                msg = "Anomalous error from run_episode()"
-                logger.error(msg, e=traceback.format_exc())
-                raise
-            finally:
-                fw.close()
-                os.rename(fn_tmp, fn)
-
-            logger.debug("Now creating visualization and analyzing statistics.")
-
-            if length_s == 0:
-                continue
-
-            with ProcessPoolExecutor(max_workers=10) as executor:
-                output_video = os.path.join(dn, "ui_image.mp4")
-                # output_gif = os.path.join(dn, "ui_image.gif")
-                # executor.submit(ui_image_bg, fn=fn, output_video=output_video, output_gif=output_gif)
-                make_video_ui_image(log_filename=fn, output_video=output_video)
-                # out_video = os.path.join(dn, "camera.mp4")
-                # out_gif = os.path.join(dn, "camera.gif")
-                # executor.submit(ui_video2, fn, out_video, "ego0", banner_bottom_fn, out_gif)
-
-                results_stats = executor.submit(robot_stats, fn, dn, "ego0")
-                per_episode[scenario.scenario_name] = results_stats.result()
+    except:
+        agent_ci.close()
+        sim_ci.close()
+        raise
+    return sim_ci, agent_ci
+
+def make_video(fn: str, dn: str):
+    from aido_analyze.utils_video import make_video_ui_image
+    output_video = os.path.join(dn, "ui_image.mp4")
+    # output_gif = os.path.join(dn, "ui_image.gif")
+    make_video_ui_image(log_filename=fn, output_video=output_video)
+    # out_video = os.path.join(dn, "camera.mp4")
+    # out_gif = os.path.join(dn, "camera.gif")
+    # ui_video2(fn, out_video, "ego0", banner_bottom_fn, out_gif)
+
+def needs_log_analysis() -> bool:
+    """Whether anything after an episode reads its log"""
+    # Without any ui images in the log there is nothing to make a video of
+    return config["ui_image_every"] > 0 or config["verify_metrics"]
+
+def submit_analysis(pool: ProcessPoolExecutor, fn: str, dn: str, metrics: EpisodeMetrics) -> Dict[str, Future]:
+    """Start the video and statistics of an episode in the background"""
+    futures = {"stats": pool.submit(metrics.evaluate)}
+    if config["ui_image_every"] > 0:
+        futures["video"] = pool.submit(make_video, fn, dn)
+    if config["verify_metrics"]:
+        futures["offline_stats"] = pool.submit(robot_stats, fn, dn, "ego0")
+    return futures
+
+def check_stats(name: str, stats: Dict[str, float], offline_stats: Dict[str, float]):
+    """Warn about metrics that differ between the online evaluation and the one from the log"""
+    for metric in sorted(set(stats) | set(offline_stats)):
+        online, offline = stats.get(metric), offline_stats.get(metric)
+        if online is None or offline is None or abs(online - offline) > 1e-6 * max(1.0, abs(offline)):
+            logger.warning(f"Episode {name}: metric {metric} is {online} online, {offline} from the log")
+
+async def run_scenario(
+    sim_ci: ComponentInterface,
+    agent_ci: ComponentInterface,
+    log_dir: str,
+    scenario: Scenario,
+    pool: ProcessPoolExecutor,
+    run_profile: LatencyRecorder,
+) -> Optional[Tuple[str, Dict[str, Future]]]:
+    """Run one episode, returns why it ended and its analysis running in the pool, or None if it did not get going"""
+    dn = os.path.join(log_dir, scenario.scenario_name)
+    if os.path.exists(dn):
+        shutil.rmtree(dn)
+
+    if not os.path.exists(dn):
+        os.makedirs(dn)
+    # The analysis reads the plain log, chunked logs are converted for it
+    fn = os.path.join(dn, LOG_NAMES["cbor"])
+    log_fn = os.path.join(dn, LOG_NAMES[config["log_format"]])
+    fw = open_log(log_fn, config["log_format"])
+
+    agent_ci.cc(fw)
+    sim_ci.cc(fw)
+
+    logger.info(f"Now running episode {scenario.scenario_name}")
+
+    profile = LatencyRecorder()
+    metrics = EpisodeMetrics("ego0", cast(str, scenario.environment))
+    termination = TerminationPolicy(
+        config["episode_length_s"],
+        no_progress_window_s=config["no_progress_window_s"],
+        no_progress_distance=config["no_progress_distance"],
+        episode_budget_s=config["episode_budget_s"],
+        run_deadline=config["run_deadline"],
+    )
+    try:
+        length_s, reason = await run_episode(
+            sim_ci,
+            agent_ci,
+            scenario=scenario,
+            physics_dt=config["physics_dt"],
+            profile=profile,
+            log=fw,
+            metrics=metrics,
+            termination=termination,
+        )
+        logger.info(f"Finished episode {scenario.scenario_name} with length {length_s:.2f} ({reason})")
+    except:
+        msg = "Anomalous error from run_episode()"
+        logger.error(msg, e=traceback.format_exc())
+        raise
+    finally:
+        fw.close()
+        profile.save(os.path.join(dn, "profile.json"))
+        run_profile.merge(profile)
+
+    logger.debug("Now creating visualization and analyzing statistics.")
+
+    if length_s == 0:
+        return None
+
+    if log_fn != fn and needs_log_analysis():
+        await asyncio.get_event_loop().run_in_executor(None, convert_to_cbor, log_fn, fn)
+    # The simulator moves on to the next episode while this one is analyzed
+    return reason, submit_analysis(pool, fn, dn, metrics)
+
+def scenario_key(scenario: Scenario) -> str:
+    """Key of a scenario in the checkpoint, from everything its score depends on"""
+    identity = {
+        name: config[name]
+        for name in (
+            "sim_image",
+            "agent_image",
+            "seed",
+            "physics_dt",
+            "episode_length_s",
+            "no_progress_window_s",
+            "no_progress_distance",
+            "episode_budget_s",
+        )
+    }
+    identity["start"] = {
+        name: [spec.configuration.pose.x, spec.configuration.pose.y, spec.configuration.pose.theta_deg]
+        for name, spec in scenario.robots.items()
+    }
+    return episode_key(cast(str, scenario.environment), identity)
+
+async def finish_analysis(log_dir: str, scenario: Scenario, reason: str, futures: Dict[str, Future]) -> dict:
+    """Wait for the analysis of an episode, and record its statistics in the checkpoint"""
+    results = dict(zip(futures, await asyncio.gather(*map(asyncio.wrap_future, futures.values()))))
+    stats = dict(results["stats"], termination=reason)
+    if "offline_stats" in results:
+        check_stats(scenario.scenario_name, results["stats"], results["offline_stats"])
+    if config["log_format"] != "cbor" and needs_log_analysis():
+        # Only converted for the analysis, the chunked log is what is kept
+        os.remove(os.path.join(log_dir, scenario.scenario_name, LOG_NAMES["cbor"]))
+    # Cut short by the run budget, so it still has to run in full when resuming
+    if reason != RUN_BUDGET:
+        record_episode(config["checkpoint"], scenario_key(scenario), scenario.scenario_name, stats)
+    return stats
+
+async def run_replica(
+    index: int,
+    queue: "asyncio.Queue[Scenario]",
+    log_dir: str,
+    pool: ProcessPoolExecutor,
+    analyses: Dict[str, "asyncio.Task[dict]"],
+    run_profile: LatencyRecorder,
+):
+    """Run scenarios from the queue on one simulator and agent pair, until the queue is empty"""
+    loop = asyncio.get_event_loop()
+    sim_ci, agent_ci = await loop.run_in_executor(None, connect_replica, index)
+    if config["transport"] == "async":
+        sim_ci, agent_ci = AsyncComponentInterface(sim_ci), AsyncComponentInterface(agent_ci)
+    try:
+        while not queue.empty():
+            if config["run_deadline"] is not None and time.monotonic() >= config["run_deadline"]:
+                skipped = 0
+                while not queue.empty():
+                    queue.get_nowait()
+                    skipped += 1
+                logger.warning(f"Run budget used up, skipping the last {skipped} scenarios")
+                break
+            scenario = queue.get_nowait()
+            analysis = await run_scenario(sim_ci, agent_ci, log_dir, scenario, pool, run_profile)
+            if analysis is not None:
+                # Recorded as soon as it is done, so a crash later on doesn't lose this episode
+                analyses[scenario.scenario_name] = asyncio.ensure_future(finish_analysis(log_dir, scenario, *analysis))
     finally:
         agent_ci.close()
         sim_ci.close()
 
+async def main_async(cie: dc.ChallengeInterfaceEvaluator, log_dir: str, scenarios: List[Scenario]):
+    if not os.path.exists(config["fifo_dir"]):
+        os.makedirs(config["fifo_dir"])
+
+    finished = {}
+    if config["resume"]:
+        finished = load_checkpoint(config["checkpoint"])
+    elif os.path.exists(config["checkpoint"]):
+        os.remove(config["checkpoint"])
+
+    # Every replica takes the next scenario as soon as it is free
+    queue: "asyncio.Queue[Scenario]" = asyncio.Queue()
+    resumed = {}
+    for scenario in scenarios:
+        key = scenario_key(scenario)
+        if key in finished:
+            resumed[scenario.scenario_name] = finished[key]
+        else:
+            queue.put_nowait(scenario)
+    if resumed:
+        logger.info(f"Resuming, {len(resumed)} of {len(scenarios)} episodes are done already")
+
+    if config["run_budget_s"] > 0:
+        config["run_deadline"] = time.monotonic() + config["run_budget_s"]
+    run_profile = LatencyRecorder()
+    # A single pool analyzes all episodes, spawned so the workers don't inherit the FIFOs and threads of this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=config["analysis_jobs"], mp_context=context) as pool:
+        analyses: Dict[str, "asyncio.Task[dict]"] = {}
+        await asyncio.gather(*(run_replica(i, queue, log_dir, pool, analyses, run_profile) for i in range(config["replicas"])))
+
+        run_profile.save(os.path.join(log_dir, "profile.json"))
+        logger.info("Latencies over all episodes, in ms:\n" + "\n".join(run_profile.table()))
+
+        logger.info("Waiting for the analysis of the last episodes")
+        # In scenario order, independent of which replica finished first
+        per_episode = {}
+        for scenario in scenarios:
+            if scenario.scenario_name in resumed:
+                per_episode[scenario.scenario_name] = resumed[scenario.scenario_name]
+            elif scenario.scenario_name in analyses:
+                per_episode[scenario.scenario_name] = await analyses[scenario.scenario_name]
     cie.set_score("per-episodes", per_episode)
 
-def main(scoring_root, scenario_path, fifos_dir):
+def make_scenario(name: str, payload: str, start_x: int, start_y: int) -> Scenario:
+    tilesize = 0.585
+    x = start_x * tilesize
+    y = start_y * tilesize
+    x += tilesize * 0.2
+    y += tilesize * 0.3
+
+    return Scenario(
+        name, payload, ["ego0"], {
+            "ego0": ScenarioRobotSpec(
+                RobotConfiguration(
+                    # Duckie posisition is in meters 0,0 is bottom left 0.0 theta is facing right
+                    FriendlyPose(x, y, 0.0),
+                    FriendlyVelocity(0.0,0.0,0.0)),
+                "red", "", True, PROTOCOL_NORMAL)
+        },
+        {}, "")
+
+def main(
+    scoring_root,
+    scenario_path,
+    fifos_dir,
+    catalog_path=None,
+    where=None,
+    pipelined=True,
+    ui_image_every=1,
+    state_dump_every=1,
+    performance_every=1,
+    replicas=1,
+    analysis_jobs=None,
+    log_format="cbor",
+    verify_metrics=False,
+    episode_length_s=200,
+    no_progress_window_s=0.0,
+    no_progress_distance=0.1,
+    episode_budget_s=0.0,
+    run_budget_s=0.0,
+    transport="threads",
+    checkpoint=None,
+    resume=False,
+    sim_image="",
+    agent_image="",
+):
     config.update({
+        "checkpoint": checkpoint or os.path.join(scoring_root, CHECKPOINT_NAME),
+        "resume": resume,
+        "sim_image": sim_image,
+        "agent_image": agent_image,
+        "transport": transport,
+        "episode_length_s": episode_length_s,
+        "no_progress_window_s": no_progress_window_s,
+        "no_progress_distance": no_progress_distance,
+        "episode_budget_s": episode_budget_s,
+        "run_budget_s": run_budget_s,
+        "verify_metrics": verify_metrics,
+        "log_format": log_format,
+        "replicas": replicas,
+        "analysis_jobs": analysis_jobs or os.cpu_count(),
+        "pipelined": pipelined,
+        "ui_image_every": ui_image_every,
+        "state_dump_every": state_dump_every,
+        "performance_every": performance_every,
         "fifo_dir": fifos_dir,
-        "sim_in": fifos_dir + "/simulator-in",
-        "sim_out": fifos_dir + "/simulator-out",
     })
 
     if not os.path.exists(scoring_root):
@@ -200,37 +432,12 @@ def main(scoring_root, scenario_path, fifos_dir):
             if not os.path.exists(logdir):
                 os.makedirs(logdir)
 
-            files = [entry for entry in os.scandir(scenario_path) if entry.is_file() and entry.name.endswith(".yaml")]
-            files.sort(key=lambda x: x.name)
+            # All scenarios come from a single read of the map catalog
+            rows = load_maps(catalog_path or os.path.join(scenario_path, CATALOG_NAME), where)
             scenarios = []
-            for entry in files:
-                name = entry.name[:-5]
-                print(f"Adding map {name} to list of scenarios")
-                tilesize = 0.585
-                x = 0
-                y = 0
-                with open(entry.path[:-5] + ".start.txt") as startfile:
-                    xy = startfile.readline().split()
-                    x = int(xy[0])
-                    y = int(xy[1])
-                
-                x *= tilesize
-                y *= tilesize
-                x += tilesize * 0.2
-                y += tilesize * 0.3
-
-                with open(entry.path, "r") as file:
-                    scenario = Scenario(
-                        name, file.read(), ["ego0"], {
-                            "ego0": ScenarioRobotSpec(
-                                RobotConfiguration(
-                                    # Duckie posisition is in meters 0,0 is bottom left 0.0 theta is facing right
-                                    FriendlyPose(x, y, 0.0),
-                                    FriendlyVelocity(0.0,0.0,0.0)),
-                                "red", "", True, PROTOCOL_NORMAL)
-                        },
-                        {}, "")
-                    scenarios.append(scenario)
+            for row in rows:
+                print(f"Adding map {row['name']} to list of scenarios")
+                scenarios.append(make_scenario(row["name"], row["yaml"], row["start_x"], row["start_y"]))
             asyncio.run(main_async(cie, logdir, scenarios), debug=True)
             cie.set_score("simulation-passed", 1)
         except:
@@ -241,19 +448,74 @@ def main(scoring_root, scenario_path, fifos_dir):
             cie.set_evaluation_dir("episodes", logdir)
 
 
+def query_batch(
+    ci: ComponentInterface,
+    queries: List[Tuple[str, Any, Optional[str]]],
+    profile: Optional[LatencyRecorder] = None,
+) -> List[Optional[MsgReceived]]:
+    """
+    Send the (topic, data, expected reply topic) queries, and return their replies (None for queries without one).
+
+    When pipelined, all queries are written before any reply is read. A node handles its input in order, so the
+    replies come back in the order of the queries, and the batch takes about one round trip instead of one per query.
+
+    The latency of a topic is the time its reply took after the previous one, which is how long the node worked on it
+    when pipelined.
+    """
+    replies = []
+    if not config["pipelined"]:
+        for topic, data, expect in queries:
+            start = time.perf_counter()
+            if expect:
+                replies.append(ci.write_topic_and_expect(topic, data, expect=expect))
+            else:
+                replies.append(ci.write_topic_and_expect_zero(topic, data))
+            if profile is not None:
+                profile.add(f"topic/{topic}", time.perf_counter() - start)
+        return replies
+
+    for topic, data, _ in queries:
+        # noinspection PyProtectedMember
+        ci._write_topic(topic, data)
+    start = time.perf_counter()
+    for topic, _, expect in queries:
+        if expect:
+            replies.append(ci.read_one(expect, timeout=ci.timeout))
+        else:
+            msgs = read_reply(ci.fpout, nickname=ci.nickname, timeout=ci.timeout)
+            if msgs:
+                raise ExternalProtocolViolation(f"Expecting zero messages in reply to {topic!r}, got {msgs}")
+            replies.append(None)
+        if profile is not None:
+            now = time.perf_counter()
+            profile.add(f"topic/{topic}", now - start)
+            start = now
+    return replies
+
+def is_sampled(every: int, step: int) -> bool:
+    """Whether a topic logged every this many steps (never for 0) is logged at this step, which starts at 1"""
+    return every > 0 and (step - 1) % every == 0
+
 #TODO
 async def run_episode(
     sim_ci: ComponentInterface,
     agent_ci: ComponentInterface,
     physics_dt: float,
     scenario: Scenario,
-) -> float:
-    episode_length_s = 200 #config["episode_length_s"]
+    profile: Optional[LatencyRecorder] = None,
+    log=None,
+    metrics: Optional[EpisodeMetrics] = None,
+    termination: Optional[TerminationPolicy] = None,
+) -> Tuple[float, str]:
+    """Run an episode, returns its length in seconds of simulation and why it ended"""
+    termination = termination or TerminationPolicy(config["episode_length_s"])
+
+    loop = asyncio.get_event_loop()
 
     # clear simulation
-    sim_ci.write_topic_and_expect_zero("clear")
+    setup = [("clear", None, None)]
     # set map data
-    sim_ci.write_topic_and_expect_zero("set_map", SetMap(map_data=scenario.environment))
+    setup.append(("set_map", SetMap(map_data=scenario.environment), None))
 
     # spawn robot
     for robot_name, robot_conf in scenario.robots.items():
@@ -265,69 +527,84 @@ async def run_episode(
             color=robot_conf.color,
             simulate_camera=True,
         )
-        sim_ci.write_topic_and_expect_zero("spawn_robot", sp)
+        setup.append(("spawn_robot", sp, None))
     for duckie_name, duckie_config in scenario.duckies.items():
         sp = SpawnDuckie(name=duckie_name, color=duckie_config.color, pose=duckie_config.pose)
-        sim_ci.write_topic_and_expect_zero("spawn_duckie", sp)
+        setup.append(("spawn_duckie", sp, None))
 
     episode_start = EpisodeStart(scenario.scenario_name, yaml_payload=scenario.payload_yaml)
     # start episode
-    sim_ci.write_topic_and_expect_zero("episode_start", episode_start)
-    agent_ci.write_topic_and_expect_zero("episode_start", episode_start)
+    setup.append(("episode_start", episode_start, None))
 
     current_sim_time: float = 0.0
     steps: int = 0
     # for now, fixed timesteps
 
-    loop = asyncio.get_event_loop()
+    profile = profile or LatencyRecorder()
+    # Time spent waiting for the nodes, the rest of a step is our own orchestration
+    waited = 0.0
+
+    async def query(ci, queries: List[Tuple[str, Any, Optional[str]]]) -> List[Optional[MsgReceived]]:
+        nonlocal waited
+        start = time.perf_counter()
+        try:
+            if isinstance(ci, AsyncComponentInterface):
+                return await ci.query_batch(queries, config["pipelined"], profile)
+            # The blocking interfaces go in threads, so other replicas are not held up meanwhile
+            return await loop.run_in_executor(executor, query_batch, ci, queries, profile)
+        finally:
+            waited += time.perf_counter() - start
+
+    # Observations are relayed without decoding them, when the transport gives access to their encoding
+    forward_observations = isinstance(sim_ci, AsyncComponentInterface) and isinstance(agent_ci, AsyncComponentInterface)
+    if forward_observations:
+        sim_ci.raw_topics.add("robot_observations")
 
     stop_at = None
+    # Threads are only started once used, so not at all with the async transport
     with ThreadPoolExecutor(max_workers=10) as executor:
+        await query(sim_ci, setup)
+        await query(agent_ci, [("episode_start", episode_start, None)])
+
         while True:
             steps += 1
             if stop_at is not None:
                 if steps == stop_at:
                     logger.info(f"Reached {steps} steps. Finishing. ")
+                    reason = SIMULATOR_DONE
                     break
-            if current_sim_time >= episode_length_s:
-                logger.info(f"Reached {episode_length_s:.1f} seconds. Finishing. ")
+            reason = termination.check(current_sim_time)
+            if reason is not None:
+                logger.info(f"Reached {current_sim_time:.1f} seconds. Finishing: {reason}. ")
                 break
 
-            # tt = TimeTracker(steps)
+            step_start = time.perf_counter()
+            waited = 0.0
+            if log is not None:
+                log.mark_step(steps)
             t_effective = current_sim_time
 
-            f = functools.partial(
-                sim_ci.write_topic_and_expect,
-                "dump_state",
-                DumpState(),
-                expect="state_dump",
-            )
-            state_dump: MsgReceived[DTSimStateDump] = await loop.run_in_executor(executor, f)
-
+            # The queries of a step only depend on each other through the agent's commands, so they go out in three batches
+            sim_queries = [
+                ("get_sim_state", None, "sim_state"),
+                ("get_robot_observations", GetRobotObservations("ego0", t_effective), "robot_observations"),
+            ]
+            # Robot states are logged every step, they are what the episode is scored on
             for robot_name in scenario.robots:
-                grs = GetRobotState(robot_name=robot_name, t_effective=t_effective)
-                f = functools.partial(
-                    sim_ci.write_topic_and_expect,
-                    "get_robot_state",
-                    grs,
-                    expect="robot_state",
-                )
-                _recv: MsgReceived[RobotState] = await loop.run_in_executor(executor, f)
-
+                sim_queries.append(("get_robot_state", GetRobotState(robot_name=robot_name, t_effective=t_effective), "robot_state"))
             for duckie_name in scenario.duckies:
-                rs = GetDuckieState(duckie_name, t_effective)
-                f = functools.partial(
-                    sim_ci.write_topic_and_expect,
-                    "get_duckie_state",
-                    rs,
-                    expect="duckie_state",
-                )
-                await loop.run_in_executor(executor, f)
-
-            f = functools.partial(
-                sim_ci.write_topic_and_expect, "get_sim_state", expect="sim_state"
-            )
-            recv: MsgReceived[SimulationState] = await loop.run_in_executor(executor, f)
+                sim_queries.append(("get_duckie_state", GetDuckieState(duckie_name, t_effective), "duckie_state"))
+            if is_sampled(config["state_dump_every"], steps):
+                sim_queries.append(("dump_state", DumpState(), "state_dump"))
+            if is_sampled(config["performance_every"], steps):
+                sim_queries.append(("get_robot_performance", "ego0", "robot_performance"))
+
+            recv, recv_observations, *replies = await query(sim_ci, sim_queries)
+            for recv_state in replies[:len(scenario.robots)]:
+                if recv_state.data.robot_name == "ego0":
+                    termination.add_pose(t_effective, recv_state.data.state.pose)
+                if metrics is not None:
+                    metrics.add_robot_state(recv_state.data)
 
             sim_state: SimulationState = recv.data
             if steps % 20 == 0: logger.info("Sim state: ", sim_state=sim_state)
@@ -345,28 +622,13 @@ async def run_episode(
                     msg = f"Simulation is done. Waiting for step {stop_at} to stop."
                     logger.info(msg)
 
-            f = functools.partial(
-                sim_ci.write_topic_and_expect,
-                "get_robot_performance",
-                "ego0",
-                expect="robot_performance"
-            )
-
-            _recv: MsgReceived[RobotPerformance] = await loop.run_in_executor(executor, f)
-
-            get_robot_observations = GetRobotObservations("ego0", t_effective)
-
-            f = functools.partial(
-                sim_ci.write_topic_and_expect,
-                "get_robot_observations",
-                get_robot_observations,
-                expect="robot_observations",
-            )
-            recv_observations: MsgReceived[RobotObservations]
-            recv_observations = await loop.run_in_executor(executor, f)
-            ro: RobotObservations = recv_observations.data
-            obs = cast(DB20ObservationsWithTimestamp, ro.observations)
-            map_data = cast(str, scenario.environment)
+            if forward_observations:
+                # The camera and odometry go to the agent as the simulator encoded them
+                obs_plus = sim_ci.forward(recv_observations.data, "observations")
+            else:
+                ro: RobotObservations = recv_observations.data
+                obs = cast(DB20ObservationsWithTimestamp, ro.observations)
+                obs_plus = DB20ObservationsWithTimestamp(camera=obs.camera, odometry=obs.odometry)
 
             # if pr == PROTOCOL_FULL:
             #     obs_plus = DB20ObservationsPlusState(
@@ -377,9 +639,7 @@ async def run_episode(
             #         map_data=map_data,
             #     )
             # elif pr == PROTOCOL_NORMAL:
-            obs_plus = DB20ObservationsWithTimestamp(
-                camera=obs.camera, odometry=obs.odometry
-            )
+            #     obs_plus = DB20ObservationsWithTimestamp(camera=obs.camera, odometry=obs.odometry)
             # elif pr == PROTOCOL_STATE:
             #     obs_plus = DB20ObservationsOnlyState(
             #         your_name=agent_name,
@@ -388,43 +648,26 @@ async def run_episode(
             #     )
             # else:
             #     raise NotImplementedError(pr)
-            f = functools.partial(
-                agent_ci.write_topic_and_expect_zero,
-                "observations",
-                obs_plus,
-            )
-            await loop.run_in_executor(executor, f)
-
-            get_commands = GetCommands(t_effective)
-            # noinspection PyProtectedMember
-            f = functools.partial(agent_ci._write_topic, "get_commands", get_commands)
-            await loop.run_in_executor(executor, f)
-
-            f = functools.partial(agent_ci.read_one, "commands")
-            msg = await loop.run_in_executor(executor, f)
+            agent_queries = [
+                ("observations", obs_plus, None),
+                ("get_commands", GetCommands(t_effective), "commands"),
+            ]
+            _, msg = await query(agent_ci, agent_queries)
             cmds = msg.data
-            set_robot_commands = SetRobotCommands("ego0", t_effective, cmds)
-            f = functools.partial(
-                sim_ci.write_topic_and_expect_zero,
-                "set_robot_commands",
-                set_robot_commands,
-            )
-            await loop.run_in_executor(executor, f)
 
             current_sim_time += physics_dt
-            f = functools.partial(
-                sim_ci.write_topic_and_expect_zero, "step", Step(current_sim_time)
-            )
-            await loop.run_in_executor(executor, f)
-
+            sim_queries = [
+                ("set_robot_commands", SetRobotCommands("ego0", t_effective, cmds), None),
+                ("step", Step(current_sim_time), None),
+            ]
             # Needed to generate ui images in the log, which will be extracted when analyzed
-            f = functools.partial(
-                sim_ci.write_topic_and_expect,
-                "get_ui_image",
-                None,
-                expect="ui_image",
-            )
-            _r_ui_image: MsgReceived[JPGImage] = await loop.run_in_executor(executor, f)
+            if is_sampled(config["ui_image_every"], steps):
+                sim_queries.append(("get_ui_image", None, "ui_image"))
+            await query(sim_ci, sim_queries)
+
+            step_time = time.perf_counter() - step_start
+            profile.add("step", step_time)
+            profile.add("orchestration", step_time - waited)
 
             if steps % 100 == 0:
                 # gc.collect()
@@ -432,7 +675,7 @@ async def run_episode(
             if steps % 20 == 0:
                 logger.info(f"Sim time: {steps} steps = {steps/20} secs")
 
-    return current_sim_time
+    return current_sim_time, reason
 
 if __name__ == "__main__":
     main("../scoring_root", "../maps", "../fifos")
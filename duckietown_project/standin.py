@@ -0,0 +1,97 @@
+"""
+Stand-in simulator and agent nodes, to run the evaluator without the docker images.
+
+They speak the same protocols over the same FIFOs, but answer every query with a canned reply after a fixed delay,
+so what is left to measure is the evaluator itself. Run one with e.g.
+
+    AIDONODE_DATA_IN=fifos/simulator-in AIDONODE_DATA_OUT=fifo:fifos/simulator-out \
+        python -m duckietown_project.standin simulator --delay 0.001
+"""
+import argparse
+import dataclasses
+import time
+import typing
+
+# Reply topic of every simulator query with one
+SIMULATOR_REPLIES = {
+    "get_robot_observations": "robot_observations",
+    "get_robot_state": "robot_state",
+    "get_duckie_state": "duckie_state",
+    "get_sim_state": "sim_state",
+    "dump_state": "state_dump",
+    "get_robot_performance": "robot_performance",
+    "get_ui_image": "ui_image",
+}
+AGENT_REPLIES = {
+    "get_commands": "commands",
+}
+
+
+def canned(t, image: bytes):
+    """A value of type t with every field zero or empty, except for images"""
+    import numpy as np
+
+    origin = typing.get_origin(t)
+    if t is bytes:
+        return image
+    if t in (float, int, bool, str):
+        return t()
+    if t is np.ndarray:
+        # Poses are the only arrays in the replies
+        return np.eye(3)
+    if origin in (dict, typing.Dict):
+        return {}
+    if origin in (list, typing.List, tuple, typing.Tuple):
+        return origin()
+    if origin is typing.Union:
+        # Optional fields are left out
+        return None
+    if dataclasses.is_dataclass(t):
+        return t(**{f.name: canned(f.type, image) for f in dataclasses.fields(t)})
+    return {}
+
+
+class StandInNode:
+    """Answers the queries in replies with their canned reply, and accepts every other input"""
+
+    def __init__(self, protocol, replies: typing.Dict[str, str], delay: float, image: bytes):
+        self.replies = {query: (topic, canned(protocol.outputs[topic], image)) for query, topic in replies.items()}
+        self.delay = delay
+
+    def init(self, context):
+        pass
+
+    def __getattr__(self, name: str):
+        if not name.startswith("on_received_"):
+            raise AttributeError(name)
+        query = name[len("on_received_"):]
+
+        def on_received(context, data=None):
+            if self.delay:
+                time.sleep(self.delay)
+            if query in self.replies:
+                context.write(*self.replies[query])
+
+        return on_received
+
+
+def main():
+    from aido_schemas import protocol_agent_DB20_timestamps, protocol_simulator_DB20_timestamps
+    from zuper_nodes_wrapper import wrap_direct
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("node", choices=["simulator", "agent"])
+    parser.add_argument("--delay", default=0.0, type=float, help="seconds to take for every input")
+    parser.add_argument("--image-size", default=30000, type=int, help="bytes in every camera and ui image, they are not valid images")
+    args, rest = parser.parse_known_args()
+
+    image = b"\xff\xd8" + bytes(max(args.image_size - 4, 0)) + b"\xff\xd9"
+    if args.node == "simulator":
+        protocol, replies = protocol_simulator_DB20_timestamps, SIMULATOR_REPLIES
+    else:
+        protocol, replies = protocol_agent_DB20_timestamps, AGENT_REPLIES
+    wrap_direct(StandInNode(protocol, replies, args.delay, image), protocol, args=rest)
+
+
+if __name__ == "__main__":
+    main()
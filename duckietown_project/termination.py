@@ -0,0 +1,63 @@
+"""
+When to end an episode before its full length.
+"""
+import math
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+# Reasons an episode ended
+LENGTH = "length"
+SIMULATOR_DONE = "simulator_done"
+NO_PROGRESS = "no_progress"
+EPISODE_BUDGET = "episode_budget"
+RUN_BUDGET = "run_budget"
+
+
+class TerminationPolicy:
+    """
+    Ends an episode once it reaches its length, the robot hasn't moved more than no_progress_distance meters over
+    the last no_progress_window seconds of simulation (so it stalled or circles on the spot), or it ran out of wall
+    clock time, either its own or that of the whole run. Zero disables a window or budget.
+    """
+
+    def __init__(
+        self,
+        episode_length_s: float,
+        no_progress_window_s: float = 0.0,
+        no_progress_distance: float = 0.0,
+        episode_budget_s: float = 0.0,
+        run_deadline: Optional[float] = None,
+    ):
+        self.episode_length_s = episode_length_s
+        self.no_progress_window_s = no_progress_window_s
+        self.no_progress_distance = no_progress_distance
+        self.episode_deadline = time.monotonic() + episode_budget_s if episode_budget_s > 0 else None
+        self.run_deadline = run_deadline
+        # Sim time and position of the robot, over the last window
+        self.positions: Deque[Tuple[float, float, float]] = deque()
+
+    def add_pose(self, sim_time: float, pose):
+        """The SE2 pose of the robot (a 3x3 matrix) at this sim time"""
+        if self.no_progress_window_s <= 0:
+            return
+        self.positions.append((sim_time, float(pose[0][2]), float(pose[1][2])))
+        # Keep the newest sample that is at least a window old, it is the one to compare with
+        while len(self.positions) > 1 and sim_time - self.positions[1][0] >= self.no_progress_window_s:
+            self.positions.popleft()
+
+    def check(self, sim_time: float) -> Optional[str]:
+        """Why the episode should end now, if it should"""
+        if sim_time >= self.episode_length_s:
+            return LENGTH
+        now = time.monotonic()
+        if self.run_deadline is not None and now >= self.run_deadline:
+            return RUN_BUDGET
+        if self.episode_deadline is not None and now >= self.episode_deadline:
+            return EPISODE_BUDGET
+        if self.no_progress_window_s > 0 and self.positions:
+            t0, x0, y0 = self.positions[0]
+            _, x1, y1 = self.positions[-1]
+            if sim_time - t0 >= self.no_progress_window_s and math.hypot(x1 - x0, y1 - y0) < self.no_progress_distance:
+                return NO_PROGRESS
+        return None
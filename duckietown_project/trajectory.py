@@ -0,0 +1,56 @@
+"""
+Trajectories of the robot, recorded step by step into preallocated arrays and saved as a .npz file.
+
+Every step has the episode it belongs to, the robot's position (x, y, z in the simulator's frame, y is up) and angle
+after the step, the action, the reward and whether the episode was done.
+"""
+import os
+from typing import Dict
+
+import numpy as np
+
+FIELDS = {
+    "episode": ((), np.int32),
+    "position": ((3,), np.float32),
+    "angle": ((), np.float32),
+    "action": ((2,), np.float32),
+    "reward": ((), np.float32),
+    "done": ((), np.bool_),
+}
+
+
+class TrajectoryRecorder:
+    def __init__(self, path: str, capacity: int = 1500):
+        self.path = path
+        self.steps = 0
+        self.episode = 0
+        self.arrays = {name: np.empty((capacity,) + shape, dtype) for name, (shape, dtype) in FIELDS.items()}
+
+    def add(self, position, angle: float, action, reward: float, done: bool):
+        if self.steps == len(self.arrays["episode"]):
+            self.arrays = {name: np.concatenate([array, np.empty_like(array)]) for name, array in self.arrays.items()}
+        i = self.steps
+        self.arrays["episode"][i] = self.episode
+        self.arrays["position"][i] = position
+        self.arrays["angle"][i] = angle
+        self.arrays["action"][i] = action
+        self.arrays["reward"][i] = reward
+        self.arrays["done"][i] = done
+        self.steps += 1
+
+    def end_episode(self):
+        """Save everything recorded so far, the next steps belong to a new episode"""
+        self.episode += 1
+        self.flush()
+
+    def flush(self):
+        # Written next to the file and renamed, so a crash never leaves a truncated recording
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, **{name: array[:self.steps] for name, array in self.arrays.items()})
+        os.replace(tmp_path, self.path)
+
+
+def load_trajectory(path: str) -> Dict[str, np.ndarray]:
+    """The arrays of a recording, by field"""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
@@ -1,13 +1,33 @@
-from duckietown_world import MapFormat1
-from gym_duckietown.envs import DuckietownEnv
-from PIL import Image
+from __future__ import annotations
 from duckietown_project.const import *
-from typing import List, Tuple
+from typing import List, Sequence, Tuple, TYPE_CHECKING
 import logging
+import numpy as np
+from itertools import chain
 
-mock_env = DuckietownEnv(seed=1)
+if TYPE_CHECKING:
+    from duckietown_world import MapFormat1
+
+# One simulator per process, only used for rendering map previews
+mock_env = None
+
+def get_mock_env():
+    global mock_env
+    if mock_env is None:
+        # Imported here, so that workers can switch pyglet to headless before it is loaded
+        from gym_duckietown.envs import DuckietownEnv
+        mock_env = DuckietownEnv(seed=1)
+    return mock_env
+
+def init_render_worker():
+    """Initializer for the rendering process pool, gives each worker its own headless simulator"""
+    import pyglet
+    pyglet.options["headless"] = True
+    get_mock_env()
 
 def save_map_image(map_data: MapFormat1, path: str):
+    from PIL import Image
+    mock_env = get_mock_env()
     mock_env.map_data = map_data
     mock_env._interpret_map(mock_env.map_data)
     mock_env.reset()
@@ -16,64 +36,82 @@ def save_map_image(map_data: MapFormat1, path: str):
     im.save(path)
 
 
-def edge_path_to_format(edges: List[Tuple[int, int]]):
-    map_dict: MapFormat1 = {}
-    map_dict["tile_size"] = TILE_SIZE
-    map_dict["tiles"] = graph_transform(edge_path_to_grid(edges))
-    map_dict["objects"] = []
-    return map_dict
-
-
-def empty() -> List[List[Tuple[int, int, int, int]]]:
-    cycle_map = []
-    for i in range(HEIGHT):
-        # cycle_map.append([(i != 0, True, i != HEIGHT - 1, False)] + [(i != 0, True, i != HEIGHT - 1, True)] * (WIDTH - 2) + [(i != 0, False, i != HEIGHT - 1, True)])
-        cycle_map.append([(False, False, False, False)] * WIDTH)
-    return cycle_map
-
-
-def edge_path_to_grid(edges: List[Tuple[int, int]]) -> List[List[Tuple[int, int, int, int]]]:
-    c_len = len(edges)
-    cycle_map = empty()
-    for i in range(c_len):
-        neighs = [edges[i - 1], edges[(i + 1) % c_len]]
-        x, y = edges[i]
-        cycle_map[y][x] = ((x, y - 1) in neighs, (x + 1, y) in neighs, (x, y + 1) in neighs, (x - 1, y) in neighs)
-    return cycle_map
-
-
-def graph_transform(conn_map: List[List[Tuple[int, int, int, int]]]) -> List[List[str]]:
-    tile_map = []
-    for _ in range(HEIGHT):
-        tile_map.append(["grass"] * WIDTH)
-    
-    for y in range(HEIGHT):
-        for x in range(WIDTH):
-            if conn_map[y][x] == (False,False,False,False):
-                tile_map[y][x] = "grass"
-            elif conn_map[y][x] == (False, True, False, True):
-                tile_map[y][x] = "straight/E"
-            elif conn_map[y][x] == (True, False, True, False):
-                tile_map[y][x] = "straight/S"
-            elif conn_map[y][x] == (True, True, False, False):
-                tile_map[y][x] = "curve_left/S"
-            elif conn_map[y][x] == (False, True, True, False):
-                tile_map[y][x] = "curve_left/W"
-            elif conn_map[y][x] == (False, False, True, True):
-                tile_map[y][x] = "curve_left/N"
-            elif conn_map[y][x] == (True, False, False, True):
-                tile_map[y][x] = "curve_left/E"
-            elif conn_map[y][x] == (True, True, True, False):
-                tile_map[y][x] = "3way_left/S"
-            elif conn_map[y][x] == (False, True, True, True):
-                tile_map[y][x] = "3way_left/W"
-            elif conn_map[y][x] == (True, False, True, True):
-                tile_map[y][x] = "3way_left/N"
-            elif conn_map[y][x] == (True, True, False, True):
-                tile_map[y][x] = "3way_left/E"
-            elif conn_map[y][x] == (True, True, False, True):
-                tile_map[y][x] = "4way/E"
-            else:
-                tile_map[y][x] = "4way/E"
-                logging.error(f"Unknown tile: {x} {y}")
-    return tile_map
+def edge_path_to_format(edges: List[Tuple[int, int]], width: int = WIDTH, height: int = HEIGHT):
+    return edge_paths_to_formats([edges], width, height)[0]
+
+
+def edge_paths_to_formats(loops: Sequence[List[Tuple[int, int]]], width: int = WIDTH, height: int = HEIGHT) -> List[MapFormat1]:
+    """Convert a batch of loops to maps, all tiles are classified in one go"""
+    maps = []
+    for tiles in graph_transform(edge_paths_to_grids(loops, width, height)):
+        map_dict: MapFormat1 = {}
+        map_dict["tile_size"] = TILE_SIZE
+        map_dict["tiles"] = tiles
+        map_dict["objects"] = []
+        maps.append(map_dict)
+    return maps
+
+
+# Connectivity of a tile is a 4 bit mask of the directions it connects to
+NORTH = 1
+EAST = 2
+SOUTH = 4
+WEST = 8
+
+# Direction bit for a step of (dx, dy), indexed by (dy + 1) * 3 + (dx + 1)
+STEP_BITS = np.array([0, NORTH, 0, WEST, 0, EAST, 0, SOUTH, 0], dtype=np.uint8)
+
+# Tile name for each connectivity mask
+TILE_NAMES = np.full(16, "4way/E", dtype=object)
+TILE_NAMES[0] = "grass"
+TILE_NAMES[EAST | WEST] = "straight/E"
+TILE_NAMES[NORTH | SOUTH] = "straight/S"
+TILE_NAMES[NORTH | EAST] = "curve_left/S"
+TILE_NAMES[EAST | SOUTH] = "curve_left/W"
+TILE_NAMES[SOUTH | WEST] = "curve_left/N"
+TILE_NAMES[NORTH | WEST] = "curve_left/E"
+TILE_NAMES[NORTH | EAST | SOUTH] = "3way_left/S"
+TILE_NAMES[EAST | SOUTH | WEST] = "3way_left/W"
+TILE_NAMES[NORTH | SOUTH | WEST] = "3way_left/N"
+TILE_NAMES[NORTH | EAST | WEST] = "3way_left/E"
+TILE_NAMES[NORTH | EAST | SOUTH | WEST] = "4way/E"
+
+# Masks without a tile, a single connection is a dead end
+UNKNOWN_MASKS = np.array([bin(mask).count("1") == 1 for mask in range(16)])
+
+
+def edge_path_to_grid(edges: List[Tuple[int, int]], width: int = WIDTH, height: int = HEIGHT) -> np.ndarray:
+    return edge_paths_to_grids([edges], width, height)[0]
+
+
+def edge_paths_to_grids(loops: Sequence[List[Tuple[int, int]]], width: int = WIDTH, height: int = HEIGHT) -> np.ndarray:
+    """Connectivity masks of a batch of loops, as an array of shape (len(loops), height, width)"""
+    conn_maps = np.zeros((len(loops), height, width), dtype=np.uint8)
+    if not loops:
+        return conn_maps
+
+    # All loops are concatenated, the previous and next cell wrap around within each loop
+    lengths = np.array([len(edges) for edges in loops])
+    cells = np.fromiter(chain.from_iterable(chain.from_iterable(loops)), dtype=np.intp).reshape(-1, 2)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    idx = np.arange(len(cells))
+    next_idx = idx + 1
+    next_idx[ends - 1] = starts
+    prev_idx = idx - 1
+    prev_idx[starts] = ends - 1
+
+    def step_bits(delta: np.ndarray) -> np.ndarray:
+        return STEP_BITS[(delta[:, 1] + 1) * 3 + (delta[:, 0] + 1)]
+
+    loop_idx = np.repeat(np.arange(len(loops)), lengths)
+    conn_maps[loop_idx, cells[:, 1], cells[:, 0]] = step_bits(cells[next_idx] - cells) | step_bits(cells[prev_idx] - cells)
+    return conn_maps
+
+
+def graph_transform(conn_map: np.ndarray) -> List:
+    """Tile names for a single connectivity mask grid or a batch of them"""
+    unknown = np.argwhere(UNKNOWN_MASKS[conn_map])
+    for *_, y, x in unknown:
+        logging.error(f"Unknown tile: {x} {y}")
+    return TILE_NAMES[conn_map].tolist()
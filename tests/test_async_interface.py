@@ -0,0 +1,41 @@
+import pytest
+
+cbor2 = pytest.importorskip("cbor2")
+pytest.importorskip("zuper_nodes_wrapper")
+
+from duckietown_project.async_interface import _item_end, map_value, message_head, with_schema
+
+OBSERVATIONS = {"camera": {"jpg_data": bytes(70000), "timestamp": 1.5}, "odometry": {"timestamp": 1.5, "axis_left_rad": -2.0}}
+MESSAGE = cbor2.dumps(
+    {"compat": ["z2"], "topic": "robot_observations", "data": {"robot_name": "ego0", "t_effective": 1.5, "observations": OBSERVATIONS}}
+)
+
+
+def test_map_value_finds_nested_encoding():
+    encoded = map_value(map_value(MESSAGE, "data"), "observations")
+    assert cbor2.loads(encoded) == OBSERVATIONS
+    with pytest.raises(KeyError):
+        map_value(MESSAGE, "timing")
+
+
+def test_item_end_of_whole_and_cut_message():
+    assert _item_end(MESSAGE, 0) == len(MESSAGE)
+    # Either runs past the end or finds it cut short, never a message that isn't there
+    for cut in (1, 10, 40, len(MESSAGE) - 1):
+        try:
+            assert _item_end(MESSAGE[:cut], 0) > cut
+        except IndexError:
+            pass
+
+
+def test_spliced_message_decodes_as_encoded_one():
+    data = map_value(map_value(MESSAGE, "data"), "observations")
+    spliced = message_head("observations") + bytes(data)
+    assert cbor2.loads(spliced) == {"compat": ["z2"], "topic": "observations", "data": OBSERVATIONS}
+
+
+def test_with_schema_adds_schema_to_map():
+    schema = cbor2.dumps({"title": "DB20ObservationsWithTimestamp"})
+    data = map_value(map_value(MESSAGE, "data"), "observations")
+    logged = cbor2.loads(b"".join(bytes(piece) for piece in with_schema(data, schema)))
+    assert logged == dict(OBSERVATIONS, **{"$schema": {"title": "DB20ObservationsWithTimestamp"}})
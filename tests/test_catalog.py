@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from duckietown_project.catalog import add_map, load_maps, open_catalog
+
+
+def test_load_maps_without_catalog_fails(tmp_path):
+    path = str(tmp_path / "catalog.sqlite")
+    with pytest.raises(FileNotFoundError):
+        load_maps(path)
+    assert not os.path.exists(path)
+
+
+def test_load_maps_fails_when_nothing_matches(tmp_path):
+    path = str(tmp_path / "catalog.sqlite")
+    conn = open_catalog(path)
+    conn.commit()
+    conn.close()
+    with pytest.raises(ValueError):
+        load_maps(path)
+
+    conn = open_catalog(path)
+    add_map(conn, "map_0", 0, "hash", (5, 5), 8, {"straight/E": 1}, (0, 0), "tiles: []", "content")
+    conn.commit()
+    conn.close()
+    assert [row["name"] for row in load_maps(path)] == ["map_0"]
+    with pytest.raises(ValueError):
+        load_maps(path, "loop_length > 8")
@@ -0,0 +1,56 @@
+import pytest
+
+from duckietown_project.checkpoint import load_checkpoint, record_episode
+
+MAP_A = """tile_size: 0.585
+tiles:
+- [curve_left/W, curve_left/N]
+- [curve_left/S, curve_left/E]
+objects: []
+"""
+MAP_B = MAP_A.replace("objects: []", "objects: [{kind: duckie, pos: [0.5, 0.5], rotate: 0, height: 0.08}]")
+
+
+@pytest.fixture
+def run_automated():
+    pytest.importorskip("aido_schemas")
+    pytest.importorskip("duckietown_challenges")
+    from duckietown_project import run_automated
+    return run_automated
+
+
+def test_scenarios_of_different_maps_have_different_keys(run_automated):
+    a = run_automated.make_scenario("map_0", MAP_A, 0, 0)
+    b = run_automated.make_scenario("map_1", MAP_B, 0, 0)
+    assert run_automated.scenario_key(a) != run_automated.scenario_key(b)
+
+
+def test_scenario_key_depends_on_map_and_start_not_name(run_automated):
+    key = run_automated.scenario_key(run_automated.make_scenario("map_0", MAP_A, 0, 0))
+    assert run_automated.scenario_key(run_automated.make_scenario("renamed", MAP_A, 0, 0)) == key
+    assert run_automated.scenario_key(run_automated.make_scenario("map_0", MAP_A, 1, 0)) != key
+
+
+def test_resume_only_skips_recorded_map(run_automated, tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    a = run_automated.make_scenario("map_0", MAP_A, 0, 0)
+    b = run_automated.make_scenario("map_1", MAP_B, 0, 0)
+    record_episode(path, run_automated.scenario_key(a), a.scenario_name, {"survival_time": 1.0})
+
+    finished = load_checkpoint(path)
+
+    assert finished == {run_automated.scenario_key(a): {"survival_time": 1.0}}
+    assert run_automated.scenario_key(b) not in finished
+
+
+def test_record_after_truncated_line(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    record_episode(path, "a", "map_0", {"survival_time": 1.0})
+    # A crash while writing the second episode
+    with open(path, "a") as f:
+        f.write('{"key": "b", "name": "map_1", "st')
+
+    assert load_checkpoint(path) == {"a": {"survival_time": 1.0}}
+
+    record_episode(path, "c", "map_2", {"survival_time": 3.0})
+    assert load_checkpoint(path) == {"a": {"survival_time": 1.0}, "c": {"survival_time": 3.0}}
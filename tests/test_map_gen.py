@@ -0,0 +1,72 @@
+import argparse
+from random import Random
+
+import pytest
+
+from duckietown_project import map_gen
+from duckietown_project.const import MIN_LOOP_LENGTH, TILE_SIZE
+
+
+@pytest.fixture
+def grid_args(monkeypatch):
+    def set_grid(width: int, height: int, **kwargs):
+        params = dict(width=width, height=height, min_length=MIN_LOOP_LENGTH, keep_mirrored=False)
+        params.update(kwargs)
+        monkeypatch.setattr(map_gen, "args", argparse.Namespace(**params))
+    return set_grid
+
+
+@pytest.mark.parametrize("width,height", [(4, 4), (5, 5), (3, 5), (4, 6), (6, 4)])
+def test_all_loops_matches_networkx(grid_args, width, height):
+    nx = pytest.importorskip("networkx")
+    grid_args(width, height)
+    # A chordless cycle is determined by its cells
+    loops = [frozenset(cycle) for cycle in map_gen.all_loops()]
+    assert len(loops) == len(set(loops))
+
+    grid = nx.grid_2d_graph(width, height, create_using=nx.DiGraph)
+    expected = {frozenset(cycle) for cycle in nx.simple_cycles(grid)
+                if len(cycle) >= MIN_LOOP_LENGTH and map_gen.validate_cycle(cycle)}
+    assert set(loops) == expected
+
+
+def test_unique_maps_of_5x5(grid_args):
+    grid_args(5, 5)
+    assert len(list(map_gen.unique_cycles(map_gen.all_loops()))) == 32
+
+
+def test_sampled_loops_are_valid_and_distinct(grid_args):
+    grid_args(7, 6)
+    loops = map_gen.sample_loops(20, seed=3)
+    assert len(loops) == 20
+    for loop in loops:
+        assert len(loop) >= MIN_LOOP_LENGTH
+        assert map_gen.validate_cycle(loop)
+    assert len({map_gen.canonical_cycle(loop) for loop in loops}) == len(loops)
+    assert map_gen.sample_loops(20, seed=3) == loops
+
+
+# Border of a 4x4 square
+RING = [(x, 0) for x in range(4)] + [(3, y) for y in range(1, 4)] + [(x, 3) for x in range(2, -1, -1)] + [(0, 2), (0, 1)]
+
+
+def check_placements(placements, min_dist):
+    for i, (x, y) in enumerate(placements):
+        assert (int(x), int(y)) in RING
+        for ox, oy in placements[:i]:
+            assert ((x - ox) ** 2 + (y - oy) ** 2) ** 0.5 * TILE_SIZE >= min_dist
+
+
+def test_object_placement_keeps_distance_on_road():
+    placements, report = map_gen.object_placement(20, 0.2, RING, Random(1))
+    assert report == map_gen.PlacementReport(20, 20, 0.2)
+    assert len(placements) == 20
+    check_placements(placements, 0.2)
+
+
+def test_object_placement_reports_crowded_loop():
+    placements, report = map_gen.object_placement(300, 0.2, RING, Random(1))
+    assert report.requested == 300
+    assert 0 < report.placed < 300
+    assert len(placements) == report.placed
+    check_placements(placements, 0.2)
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from duckietown_project.metrics import EpisodeMetrics
+
+pytest.importorskip("duckietown_world")
+
+MAP_YAML = """tile_size: 0.585
+tiles:
+- [curve_left/W, curve_left/N]
+- [curve_left/S, curve_left/E]
+objects: []
+"""
+
+
+def robot_state(t: float, x: float, y: float, robot_name: str = "ego0"):
+    pose = np.array([[1.0, 0.0, x], [0.0, 1.0, y], [0.0, 0.0, 1.0]])
+    return SimpleNamespace(robot_name=robot_name, t_effective=t, state=SimpleNamespace(pose=pose))
+
+
+def test_evaluate_on_map():
+    metrics = EpisodeMetrics("ego0", MAP_YAML)
+    for step in range(10):
+        metrics.add_robot_state(robot_state(step * 0.05, 0.3 + step * 0.02, 0.15))
+    # Other robots and repeated timestamps are ignored
+    metrics.add_robot_state(robot_state(0.5, 5.0, 5.0, robot_name="npc0"))
+    metrics.add_robot_state(robot_state(0.45, 5.0, 5.0))
+
+    stats = metrics.evaluate()
+
+    assert stats["distance-from-start"] == pytest.approx(0.18)
+    assert stats["survival_time"] == pytest.approx(0.45)
+    assert all(isinstance(value, float) for value in stats.values())